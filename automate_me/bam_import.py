@@ -3,12 +3,15 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
-import datetime
 import os
 import time
-import azure.storage.blob
+import traceback
 import pandas as pd
 import pysam
+from concurrent.futures import ThreadPoolExecutor
+from utils.bam import get_bam_header_blob
+from utils.blobs import BlobIndex, get_blob_properties, get_block_blob_service
+from utils.header_cache import BamHeaderCache, get_header_metadata
 from utils.runtime_args import parse_runtime_args
 from utils.tantalus import TantalusApi
 
@@ -40,26 +43,17 @@ def get_bam_aligner_name(bam_header):
     raise Exception("no aligner name found")
 
 
-def get_bam_header_file(filename):
-    return pysam.AlignmentFile(filename).header
-
-
-def get_bam_header_blob(blob_service, container_name, blob_name):
-    sas_token = blob_service.generate_blob_shared_access_signature(
-        container_name,
-        blob_name,
-        permission=azure.storage.blob.BlobPermissions.READ,
-        expiry=datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+def get_bam_header_metadata(bam_header):
+    """Get everything the import needs from a BAM header."""
+    return dict(
+        ref_genome=get_bam_ref_genome(bam_header),
+        aligner_name=get_bam_aligner_name(bam_header),
+        header_info=get_bam_header_info(bam_header),
     )
 
-    blob_url = blob_service.make_blob_url(
-        container_name=container_name,
-        blob_name=blob_name,
-        protocol="http",
-        sas_token=sas_token,
-    )
 
-    return pysam.AlignmentFile(blob_url).header
+def get_bam_header_file(filename):
+    return pysam.AlignmentFile(filename).header
 
 
 def get_bam_header_info(header):
@@ -116,59 +110,68 @@ def get_created_time_file(filename):
     return pd.Timestamp(time.ctime(os.path.getmtime(filename)), tz="Canada/Pacific")
 
 
-def get_size_blob(blob_service, container, blobname):
-    properties = blob_service.get_blob_properties(container, blobname)
-    blobsize = properties.properties.content_length
-    return blobsize
+def get_bam_file_metadata(storage, bam_filename, header_cache=None):
+    """Get a BAM's header metadata and the info of its BAM and BAI files."""
+    if storage["storage_type"] == "blob":
+        return import_bam_blob(
+            bam_filename, storage["storage_container"], header_cache=header_cache
+        )
+    elif storage["storage_type"] == "server":
+        return import_bam_server(
+            bam_filename, storage["storage_directory"], header_cache=header_cache
+        )
 
+    raise ValueError("unsupported storage type {}".format(storage["storage_type"]))
 
-def get_created_time_blob(blob_service, container, blobname):
-    properties = blob_service.get_blob_properties(container, blobname)
-    created_time = properties.properties.last_modified.isoformat()
-    return created_time
 
+def get_tag_pks(tantalus_api, tag_name=None):
+    if tag_name is None:
+        return []
 
-def import_bam(
-    tantalus_api,
-    storage_name,
-    dataset_name,
-    bam_filename,
-    read_type,
-    sequencing_centre,
-    tag_name=None,
-):
-    storage = tantalus_api.get("storage", name=storage_name)
+    return [tantalus_api.get("sequence_dataset_tag", name=tag_name)["id"]]
 
-    # TODO(mwiens91): What's this for? It isn't being used anywhere.
-    metadata = []
 
-    if storage["storage_type"] == "blob":
-        bam_header, file_resources = import_bam_blob(
-            bam_filename, storage["storage_container"]
-        )
-    elif storage["storage_type"] == "server":
-        bam_header, file_resources = import_bam_server(
-            bam_filename, storage["storage_directory"]
-        )
-    else:
-        raise ValueError("unsupported storage type {}".format(storage["storage_type"]))
+def get_pk(tantalus_api, table_name, pks=None, **fields):
+    """Get the primary key of a model, memoized in pks if it's given."""
+    if pks is None:
+        return tantalus_api.get(table_name, **fields)["id"]
 
-    ref_genome = get_bam_ref_genome(bam_header)
-    aligner_name = get_bam_aligner_name(bam_header)
-    bam_header_info = get_bam_header_info(bam_header)
+    key = (table_name, tuple(sorted(fields.items())))
 
-    sample_pk = tantalus_api.get("sample", sample_id=bam_header_info["sample_id"])["id"]
+    if key not in pks:
+        pks[key] = tantalus_api.get(table_name, **fields)["id"]
 
-    library_pk = tantalus_api.get(
-        "dna_library", library_id=bam_header_info["library_id"]
-    )["id"]
+    return pks[key]
 
-    if tag_name is not None:
-        tag_pk = tantalus_api.get("sequence_dataset_tag", name=tag_name)["id"]
 
-        tags = [tag_pk]
-    else:
-        tags = []
+def create_bam_dataset(
+    tantalus_api,
+    storage,
+    dataset_name,
+    header_metadata,
+    file_resources,
+    read_type,
+    sequencing_centre,
+    tags,
+    pks=None,
+):
+    """Create the models of a BAM dataset in Tantalus.
+
+    Args:
+        pks: A dictionary of already looked up primary keys to share
+            with other datasets, or None to look everything up.
+    """
+    ref_genome = header_metadata["ref_genome"]
+    aligner_name = header_metadata["aligner_name"]
+    bam_header_info = header_metadata["header_info"]
+
+    sample_pk = get_pk(
+        tantalus_api, "sample", pks, sample_id=bam_header_info["sample_id"]
+    )
+
+    library_pk = get_pk(
+        tantalus_api, "dna_library", pks, library_id=bam_header_info["library_id"]
+    )
 
     sequence_lane_pks = []
 
@@ -217,7 +220,114 @@ def import_bam(
     return sequence_dataset
 
 
-def import_bam_blob(bam_filename, container_name):
+def import_bam(
+    tantalus_api,
+    storage_name,
+    dataset_name,
+    bam_filename,
+    read_type,
+    sequencing_centre,
+    tag_name=None,
+    header_cache_path=None,
+):
+    storage = tantalus_api.get("storage", name=storage_name)
+
+    if header_cache_path is not None:
+        header_cache = BamHeaderCache(header_cache_path, "bam_import")
+    else:
+        header_cache = None
+
+    header_metadata, file_resources = get_bam_file_metadata(
+        storage, bam_filename, header_cache=header_cache
+    )
+
+    return create_bam_dataset(
+        tantalus_api,
+        storage,
+        dataset_name,
+        header_metadata,
+        file_resources,
+        read_type,
+        sequencing_centre,
+        get_tag_pks(tantalus_api, tag_name),
+    )
+
+
+def import_bams(
+    tantalus_api,
+    storage_name,
+    bams,
+    tag_name=None,
+    header_cache_path=None,
+    num_workers=8,
+):
+    """Import several BAMs into their own datasets in one run.
+
+    The storage, tag, samples and libraries are looked up once for all
+    the BAMs, and the headers are read num_workers at a time while the
+    datasets are created. A BAM which fails doesn't stop the others.
+
+    Args:
+        bams: A list of dictionaries, each with the dataset_name,
+            bam_filename, read_type and sequencing_centre of a BAM.
+
+    Returns:
+        A list with a dictionary for each BAM, in order, with its
+        dataset_name and bam_filename, and either the created dataset
+        or the error which stopped it.
+    """
+    storage = tantalus_api.get("storage", name=storage_name)
+
+    if header_cache_path is not None:
+        header_cache = BamHeaderCache(header_cache_path, "bam_import")
+    else:
+        header_cache = None
+
+    tags = get_tag_pks(tantalus_api, tag_name)
+    pks = {}
+
+    results = []
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    try:
+        futures = [
+            executor.submit(
+                get_bam_file_metadata, storage, bam["bam_filename"], header_cache
+            )
+            for bam in bams
+        ]
+
+        for bam, future in zip(bams, futures):
+            result = dict(
+                dataset_name=bam["dataset_name"], bam_filename=bam["bam_filename"]
+            )
+
+            try:
+                header_metadata, file_resources = future.result()
+
+                result["dataset"] = create_bam_dataset(
+                    tantalus_api,
+                    storage,
+                    bam["dataset_name"],
+                    header_metadata,
+                    file_resources,
+                    bam["read_type"],
+                    bam["sequencing_centre"],
+                    tags,
+                    pks=pks,
+                )
+            except Exception:
+                result["error"] = traceback.format_exc()
+
+            results.append(result)
+    finally:
+        executor.shutdown()
+
+    return results
+
+
+def import_bam_blob(bam_filename, container_name, header_cache=None):
     # Assumption: bam filename is prefixed by container name
     bam_filename = bam_filename.strip("/")
 
@@ -232,31 +342,58 @@ def import_bam_blob(bam_filename, container_name):
 
     bai_filename = bam_filename + ".bai"
 
-    blob_service = azure.storage.blob.BlockBlobService(
-        account_name=os.environ["AZURE_STORAGE_ACCOUNT"],
-        account_key=os.environ["AZURE_STORAGE_KEY"],
+    blob_service = get_block_blob_service()
+
+    # The BAM and BAI are the only blobs with the BAM's name as a prefix,
+    # so one listing gets the properties of both
+    blob_index = BlobIndex(
+        container_name,
+        {
+            blob.name: blob.properties
+            for blob in blob_service.list_blobs(container_name, prefix=bam_filename)
+        },
+    )
+
+    bam_properties = get_blob_properties(
+        blob_service, container_name, bam_filename, blob_index
+    )
+    bai_properties = get_blob_properties(
+        blob_service, container_name, bai_filename, blob_index
     )
 
-    bam_header = get_bam_header_blob(blob_service, container_name, bam_filename)
+    if bam_properties is None or bai_properties is None:
+        raise Exception(
+            "missing bam or bai blob for {}/{}".format(container_name, bam_filename)
+        )
 
     bam_info = {
         "filename": bam_filename,
-        "size": get_size_blob(blob_service, container_name, bam_filename),
-        "created": get_created_time_blob(blob_service, container_name, bam_filename),
+        "size": bam_properties.content_length,
+        "created": bam_properties.last_modified.isoformat(),
         "file_type": "BAM",
     }
 
+    header_metadata = get_header_metadata(
+        header_cache,
+        container_name,
+        bam_filename,
+        bam_info["size"],
+        bam_properties.etag,
+        lambda: get_bam_header_blob(blob_service, container_name, bam_filename),
+        get_bam_header_metadata,
+    )
+
     bai_info = {
         "filename": bai_filename,
-        "size": get_size_blob(blob_service, container_name, bai_filename),
-        "created": get_created_time_blob(blob_service, container_name, bai_filename),
+        "size": bai_properties.content_length,
+        "created": bai_properties.last_modified.isoformat(),
         "file_type": "BAI",
     }
 
-    return bam_header, [bam_info, bai_info]
+    return header_metadata, [bam_info, bai_info]
 
 
-def import_bam_server(bam_filepath, storage_directory):
+def import_bam_server(bam_filepath, storage_directory, header_cache=None):
     if not bam_filepath.startswith(storage_directory):
         raise ValueError(
             "{} not in storage directory {}".format(bam_filepath, storage_directory)
@@ -264,8 +401,6 @@ def import_bam_server(bam_filepath, storage_directory):
 
     bam_filename = bam_filepath.replace(storage_directory, "").lstrip("/")
 
-    bam_header = get_bam_header_file(bam_filepath)
-
     bam_info = {
         "filename": bam_filename,
         "size": get_size_file(bam_filepath),
@@ -273,6 +408,16 @@ def import_bam_server(bam_filepath, storage_directory):
         "file_type": "BAM",
     }
 
+    header_metadata = get_header_metadata(
+        header_cache,
+        storage_directory,
+        bam_filename,
+        bam_info["size"],
+        os.path.getmtime(bam_filepath),
+        lambda: get_bam_header_file(bam_filepath),
+        get_bam_header_metadata,
+    )
+
     bai_info = {
         "filename": bam_filename + ".bai",
         "size": get_size_file(bam_filepath + ".bai"),
@@ -280,7 +425,7 @@ def import_bam_server(bam_filepath, storage_directory):
         "file_type": "BAI",
     }
 
-    return bam_header, [bam_info, bai_info]
+    return header_metadata, [bam_info, bai_info]
 
 
 if __name__ == "__main__":
@@ -291,15 +436,60 @@ if __name__ == "__main__":
     # variables defined)
     tantalus_api = TantalusApi()
 
-    # Import BAMs
-    dataset = import_bam(
-        tantalus_api,
-        args["storage_name"],
-        args["dataset_name"],
-        args["bam_filename"],
-        args["read_type"],
-        args["sequencing_centre"],
-        tag_name=args.get("tag_name"),
-    )
+    # Import BAMs, either a list of them or a single one
+    if "bams" in args:
+        bams = []
+
+        # Each BAM's read type and sequencing centre default to the
+        # ones given for the whole run
+        for bam in args["bams"]:
+            bam = dict(bam)
+            bam.setdefault("read_type", args.get("read_type"))
+            bam.setdefault("sequencing_centre", args.get("sequencing_centre"))
+            bams.append(bam)
+
+        results = import_bams(
+            tantalus_api,
+            args["storage_name"],
+            bams,
+            tag_name=args.get("tag_name"),
+            header_cache_path=args.get("header_cache_path"),
+            num_workers=args.get("num_workers", 8),
+        )
+
+        failures = []
+
+        for result in results:
+            if "error" in result:
+                print(
+                    "failed {} ({}):\n{}".format(
+                        result["dataset_name"], result["bam_filename"], result["error"]
+                    )
+                )
+                failures.append(result["dataset_name"])
+            else:
+                print(
+                    "dataset {} {}".format(
+                        result["dataset_name"], result["dataset"]["id"]
+                    )
+                )
+
+        if failures:
+            raise Exception(
+                "failed to import {} of {} bams: {}".format(
+                    len(failures), len(results), ", ".join(failures)
+                )
+            )
+    else:
+        dataset = import_bam(
+            tantalus_api,
+            args["storage_name"],
+            args["dataset_name"],
+            args["bam_filename"],
+            args["read_type"],
+            args["sequencing_centre"],
+            tag_name=args.get("tag_name"),
+            header_cache_path=args.get("header_cache_path"),
+        )
 
-    print("dataset {}".format(dataset["id"]))
+        print("dataset {}".format(dataset["id"]))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Benchmarks for the transfer engines used by transfer_files.
+
+Blob benchmarks default to a local Azure storage emulator (e.g.
+Azurite listening on its default blob port), so they don't need any
+credentials or network.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from azure.storage.blob import BlockBlobService
+from utils.blobs import download_blob_ranges
+from utils.constants import LOGGING_FORMAT
+from utils.filecopy import copy_file_local
+from utils.runtime_args import parse_runtime_args
+
+# Set up the root logger
+logging.basicConfig(format=LOGGING_FORMAT, stream=sys.stdout, level=logging.INFO)
+
+
+def _as_mb_per_s(num_bytes, seconds):
+    return round(num_bytes / (1024.0 * 1024.0) / seconds, 2)
+
+
+def write_random_file(filepath, size):
+    """Write a file of random bytes, a MiB at a time."""
+    chunk_size = 1024 * 1024
+
+    with open(filepath, "wb") as f:
+        for start in range(0, size, chunk_size):
+            f.write(os.urandom(min(chunk_size, size - start)))
+
+
+def get_benchmark_blob_service(args):
+    """Connect to the emulator unless an account is given."""
+    if "account_name" in args:
+        return BlockBlobService(
+            account_name=args["account_name"], account_key=args["account_key"]
+        )
+
+    return BlockBlobService(is_emulated=True)
+
+
+def benchmark_blob_download(args):
+    """Compare single-stream and ranged blob downloads.
+
+    Uploads a blob of random bytes, then times a single-stream
+    get_blob_to_path download against ranged downloads with each
+    connection count.
+    """
+    size = int(args.get("size_mb", 1024)) * 1024 * 1024
+    container_name = args.get("container", "transfer-benchmark")
+    blob_name = "benchmark_blob_download.bin"
+
+    blob_service = get_benchmark_blob_service(args)
+    blob_service.create_container(container_name)
+
+    work_dir = tempfile.mkdtemp()
+
+    try:
+        source_filepath = os.path.join(work_dir, "source.bin")
+        write_random_file(source_filepath, size)
+        blob_service.create_blob_from_path(
+            container_name, blob_name, source_filepath, max_connections=8
+        )
+
+        results = []
+
+        download_filepath = os.path.join(work_dir, "download.bin")
+        start = time.time()
+        blob_service.get_blob_to_path(
+            container_name, blob_name, download_filepath, max_connections=1
+        )
+        results.append(("get_blob_to_path", 1, time.time() - start))
+        os.remove(download_filepath)
+
+        for connections in args.get("connections", [1, 4, 8, 16]):
+            start = time.time()
+            download_blob_ranges(
+                blob_service,
+                container_name,
+                blob_name,
+                size,
+                download_filepath,
+                max_connections=connections,
+                chunk_size=args.get("chunk_size"),
+            )
+            results.append(("download_blob_ranges", connections, time.time() - start))
+            os.remove(download_filepath)
+
+        for method, connections, seconds in results:
+            logging.info(
+                "{} with {} connections: {:.2f}s, {} MB/s".format(
+                    method, connections, seconds, _as_mb_per_s(size, seconds)
+                )
+            )
+    finally:
+        blob_service.delete_blob(container_name, blob_name)
+        shutil.rmtree(work_dir)
+
+
+def benchmark_local_copy(args):
+    """Compare rsync against native copies of a file on the same host.
+
+    Times rsync, copy_file_local (which uses the best kernel copy
+    available) and a hardlink. The source file is likely to be in the
+    page cache after it is written, so this measures copy overhead more
+    than disk speed.
+    """
+    size = int(args.get("size_mb", 1024)) * 1024 * 1024
+
+    work_dir = tempfile.mkdtemp(dir=args.get("work_dir"))
+
+    try:
+        source_filepath = os.path.join(work_dir, "source.bin")
+        write_random_file(source_filepath, size)
+
+        results = []
+
+        copy_filepath = os.path.join(work_dir, "copy.bin")
+        start = time.time()
+        subprocess.check_call(
+            [
+                "rsync",
+                "--chmod=F444",
+                "--times",
+                "--copy-links",
+                source_filepath,
+                copy_filepath,
+            ]
+        )
+        results.append(("rsync", time.time() - start))
+        os.remove(copy_filepath)
+
+        start = time.time()
+        method = copy_file_local(source_filepath, copy_filepath)
+        results.append(("copy_file_local ({})".format(method), time.time() - start))
+        os.remove(copy_filepath)
+
+        start = time.time()
+        method = copy_file_local(source_filepath, copy_filepath, hardlink=True)
+        results.append(("copy_file_local ({})".format(method), time.time() - start))
+        os.remove(copy_filepath)
+
+        for method, seconds in results:
+            logging.info(
+                "{}: {:.2f}s, {} MB/s".format(
+                    method, seconds, _as_mb_per_s(size, seconds)
+                )
+            )
+    finally:
+        shutil.rmtree(work_dir)
+
+
+BENCHMARKS = {
+    "blob_download": benchmark_blob_download,
+    "local_copy": benchmark_local_copy,
+}
+
+
+if __name__ == "__main__":
+    # Parse the incoming arguments
+    args = parse_runtime_args()
+
+    for benchmark_name in args.get("benchmarks", sorted(BENCHMARKS)):
+        logging.info("running benchmark {}".format(benchmark_name))
+        BENCHMARKS[benchmark_name](args)
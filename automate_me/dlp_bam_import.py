@@ -3,16 +3,25 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
-import datetime
+import fnmatch
 import logging
+import multiprocessing
 import os
 import sys
 import time
-import azure.storage.blob
+import traceback
 import pandas as pd
 import pysam
+from utils.bam import get_bam_header_blob
+from utils.blobs import (
+    BlobIndex,
+    get_blob_index,
+    get_blob_properties,
+    get_block_blob_service,
+)
 from utils.constants import LOGGING_FORMAT
 from utils.dlp import create_sequence_dataset_models
+from utils.header_cache import BamHeaderCache, get_header_metadata
 from utils.runtime_args import parse_runtime_args
 from utils.tantalus import TantalusApi
 
@@ -42,26 +51,17 @@ def get_bam_aligner_name(bam_header):
     raise Exception("no aligner name found")
 
 
-def get_bam_header_file(filename):
-    return pysam.AlignmentFile(filename).header
-
-
-def get_bam_header_blob(blob_service, container_name, blob_name):
-    sas_token = blob_service.generate_blob_shared_access_signature(
-        container_name,
-        blob_name,
-        permission=azure.storage.blob.BlobPermissions.READ,
-        expiry=datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+def get_bam_header_metadata(bam_header):
+    """Get everything the import needs from a BAM header."""
+    return dict(
+        ref_genome=get_bam_ref_genome(bam_header),
+        aligner_name=get_bam_aligner_name(bam_header),
+        header_info=get_bam_header_info(bam_header),
     )
 
-    blob_url = blob_service.make_blob_url(
-        container_name=container_name,
-        blob_name=blob_name,
-        protocol="http",
-        sas_token=sas_token,
-    )
 
-    return pysam.AlignmentFile(blob_url).header
+def get_bam_header_file(filename):
+    return pysam.AlignmentFile(filename).header
 
 
 def get_bam_header_info(header):
@@ -117,16 +117,120 @@ def get_created_time_file(filename):
     return pd.Timestamp(time.ctime(os.path.getmtime(filename)), tz="Canada/Pacific")
 
 
-def get_size_blob(blob_service, container, blobname):
-    properties = blob_service.get_blob_properties(container, blobname)
-    blobsize = properties.properties.content_length
-    return blobsize
+def get_blob_name(bam_filename, container_name):
+    """Get the name of a BAM blob within its container.
+
+    BAM filenames may be prefixed by storage_account/container/ or
+    container/, or not be prefixed at all.
+    """
+    storage_account = os.environ["AZURE_STORAGE_ACCOUNT"]
+
+    bam_filename = bam_filename.strip("/")
+
+    container_prefix = container_name + "/"
+    storage_account_prefix = storage_account + "/" + container_prefix
 
+    if bam_filename.startswith(storage_account_prefix):
+        return bam_filename[len(storage_account_prefix) :]
+    elif bam_filename.startswith(container_prefix):
+        return bam_filename[len(container_prefix) :]
+
+    return bam_filename
+
+
+def scan_bam_blobs(blob_service, container_name, prefix, pattern="*.bam"):
+    """Find BAM blobs under a prefix, pairing them with their BAIs.
+
+    The blobs are listed a page at a time, and each BAM is yielded as
+    soon as its BAI has been listed, so the import can start before the
+    listing is done. Blob listings are in name order, so a BAI is listed
+    shortly after its BAM. BAMs whose BAI isn't found are yielded at the
+    end.
+
+    Args:
+        blob_service: A BlockBlobService.
+        container_name: The name of the container.
+        prefix: The blob prefix to search under.
+        pattern: A glob matched against the part of each blob name after
+            the prefix.
+
+    Yields:
+        Tuples of the BAM blob name and a BlobIndex of the BAM and BAI.
+    """
+    # Listed BAMs and BAIs still waiting for the other of their pair
+    pending = {}
+
+    for blob in blob_service.list_blobs(container_name, prefix=prefix or None):
+        if blob.name.endswith(".bai"):
+            bam_name = blob.name[: -len(".bai")]
+        elif fnmatch.fnmatch(blob.name[len(prefix) :], pattern):
+            bam_name = blob.name
+        else:
+            continue
+
+        blob_properties = pending.setdefault(bam_name, {})
+        blob_properties[blob.name] = blob.properties
+
+        if bam_name in blob_properties and bam_name + ".bai" in blob_properties:
+            yield bam_name, BlobIndex(container_name, pending.pop(bam_name))
+
+    for bam_name, blob_properties in pending.items():
+        if bam_name in blob_properties:
+            yield bam_name, BlobIndex(container_name, blob_properties)
+
+
+def scan_bam_files(directory, pattern="*.bam"):
+    """Find BAM files under a directory.
+
+    Args:
+        directory: The directory to search under.
+        pattern: A glob matched against the path of each file relative
+            to the directory.
+
+    Yields:
+        The paths of the BAMs, as they are found.
+    """
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            filepath = os.path.join(dirpath, filename)
+
+            if fnmatch.fnmatch(os.path.relpath(filepath, directory), pattern):
+                yield filepath
+
+
+def _import_dlp_realign_bam(job):
+    """Get the metadata for a BAM and its BAI in a worker process.
+
+    Headers can't be sent between processes, so the header is read and
+    turned into metadata in the same process.
+
+    Args:
+        job: A tuple of the storage type, the BAM filename, the blob
+            container name or storage directory, the header cache (or
+            None), and a BlobIndex of the BAM and BAI (or None).
+
+    Returns:
+        A tuple of the BAM filename, the list of metadata (None on
+        failure), and the error (None on success).
+    """
+    storage_type, bam_filename, location, header_cache, blob_index = job
+
+    try:
+        if storage_type == "blob":
+            metadata = import_dlp_realign_bam_blob(
+                bam_filename,
+                location,
+                header_cache=header_cache,
+                blob_index=blob_index,
+            )
+        else:
+            metadata = import_dlp_realign_bam_server(
+                bam_filename, location, header_cache=header_cache
+            )
+    except Exception:
+        return bam_filename, None, traceback.format_exc()
 
-def get_created_time_blob(blob_service, container, blobname):
-    properties = blob_service.get_blob_properties(container, blobname)
-    created_time = properties.properties.last_modified.isoformat()
-    return created_time
+    return bam_filename, metadata, None
 
 
 def import_dlp_realign_bams(
@@ -136,81 +240,182 @@ def import_dlp_realign_bams(
     tantalus_api,
     tag_name=None,
     analysis_id=None,
+    processes=None,
+    header_cache_path=None,
+    bam_directory=None,
+    bam_glob="*.bam",
+    bulk=False,
     **kwargs
 ):
+    """Import DLP BAMs, reading their headers in a process pool.
+
+    Headers are read in a pool of worker processes (one per CPU unless
+    processes is given) and the results come back in the order of
+    bam_filenames. A BAM which fails doesn't stop the others from being
+    imported, and the failures are raised together at the end.
+
+    If header_cache_path is given, what is parsed from each header is
+    cached in a SQLite database at that path, and BAMs whose size and
+    modification time (or ETag) haven't changed aren't read again.
+
+    For blob storage, each directory holding many of the BAMs is listed
+    once up front, so the sizes and created times of the BAMs and BAIs
+    in it don't each need their own request.
+
+    Instead of listing bam_filenames, the BAMs can be found by giving
+    bam_directory, a directory (or blob prefix) relative to the storage,
+    and optionally bam_glob, a glob matched against the paths under it.
+    The BAMs are then imported as they are found.
+
+    If bulk is True, the models are created with a few bulk requests
+    rather than one request per model.
+    """
     metadata = []
+    failures = []
 
     storage = tantalus_api.get("storage", name=storage_name)
 
     if storage_type == "blob":
-        for bam_filename in bam_filenames:
-            blob_container_name = os.path.join(
-                storage["storage_account"], storage["storage_container"]
-            )
-            metadata.extend(
-                import_dlp_realign_bam_blob(bam_filename, blob_container_name)
-            )
+        # Blob names are relative to the container, and any path given
+        # with the container is stripped from them
+        location = storage["storage_container"]
     elif storage_type == "server":
-        for bam_filename in bam_filenames:
-
-            metadata.extend(
-                import_dlp_realign_bam_server(
-                    bam_filename, storage["storage_directory"]
-                )
-            )
+        location = storage["storage_directory"]
     else:
         raise ValueError("unsupported storage type {}".format(storage_type))
 
-    create_sequence_dataset_models(
-        metadata, storage_name, tag_name, tantalus_api, analysis_id
-    )
+    if header_cache_path is not None:
+        header_cache = BamHeaderCache(header_cache_path, "dlp_bam_import")
+    else:
+        header_cache = None
 
+    if bam_directory is not None:
+        if storage_type == "blob":
+            prefix = get_blob_name(bam_directory, location).strip("/")
 
-def import_dlp_realign_bam_blob(bam_filename, container_name):
-    storage_account = os.environ["AZURE_STORAGE_ACCOUNT"]
+            if prefix:
+                prefix += "/"
 
-    # Assumption: bam filename is prefixed by either
-    # storage_account/container/, container/, or is not prefixed
+            found_bams = scan_bam_blobs(
+                get_block_blob_service(), location, prefix, bam_glob
+            )
+        else:
+            found_bams = (
+                (bam_filepath, None)
+                for bam_filepath in scan_bam_files(
+                    os.path.join(location, bam_directory.strip("/")), bam_glob
+                )
+            )
 
-    bam_filename = bam_filename.strip("/")
+        jobs = (
+            (storage_type, bam_filename, location, header_cache, blob_index)
+            for bam_filename, blob_index in found_bams
+        )
+    elif bam_filenames is None:
+        raise ValueError("either bam_filenames or bam_directory is required")
+    elif storage_type == "blob":
+        blob_names = [
+            get_blob_name(bam_filename, location) for bam_filename in bam_filenames
+        ]
+        blob_index = get_blob_index(get_block_blob_service(), location, blob_names)
+
+        jobs = (
+            (
+                storage_type,
+                bam_filename,
+                location,
+                header_cache,
+                blob_index.subset([blob_name, blob_name + ".bai"]),
+            )
+            for bam_filename, blob_name in zip(bam_filenames, blob_names)
+        )
+    else:
+        jobs = (
+            (storage_type, bam_filename, location, header_cache, None)
+            for bam_filename in bam_filenames
+        )
 
-    container_prefix = container_name + "/"
-    storage_account_prefix = storage_account + "/" + container_prefix
+    if processes == 1:
+        results = (_import_dlp_realign_bam(job) for job in jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(_import_dlp_realign_bam, jobs)
+
+    try:
+        for bam_filename, bam_metadata, error in results:
+            if error is not None:
+                logging.error("failed to import {}:\n{}".format(bam_filename, error))
+                failures.append(bam_filename)
+                continue
+
+            metadata.extend(bam_metadata)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-    if bam_filename.startswith(storage_account_prefix):
-        bam_filename = bam_filename[len(storage_account_prefix) :]
-    elif bam_filename.startswith(container_prefix):
-        bam_filename = bam_filename[len(container_prefix) :]
+    create_sequence_dataset_models(
+        metadata, storage_name, tag_name, tantalus_api, analysis_id, bulk=bulk
+    )
+
+    if failures:
+        raise Exception(
+            "failed to import {} bams: {}".format(len(failures), ", ".join(failures))
+        )
 
+
+def import_dlp_realign_bam_blob(
+    bam_filename, container_name, header_cache=None, blob_index=None
+):
+    bam_filename = get_blob_name(bam_filename, container_name)
     bai_filename = bam_filename + ".bai"
 
-    blob_service = azure.storage.blob.BlockBlobService(
-        account_name=storage_account, account_key=os.environ["AZURE_STORAGE_KEY"]
+    blob_service = get_block_blob_service()
+
+    bam_properties = get_blob_properties(
+        blob_service, container_name, bam_filename, blob_index
+    )
+    bai_properties = get_blob_properties(
+        blob_service, container_name, bai_filename, blob_index
     )
 
-    bam_header = get_bam_header_blob(blob_service, container_name, bam_filename)
+    if bam_properties is None or bai_properties is None:
+        raise Exception(
+            "missing bam or bai blob for {}/{}".format(container_name, bam_filename)
+        )
 
     bam_info = {
         "filename": bam_filename,
-        "size": get_size_blob(blob_service, container_name, bam_filename),
-        "created": get_created_time_blob(blob_service, container_name, bam_filename),
+        "size": bam_properties.content_length,
+        "created": bam_properties.last_modified.isoformat(),
         "file_type": "BAM",
     }
 
+    header_metadata = get_header_metadata(
+        header_cache,
+        container_name,
+        bam_filename,
+        bam_info["size"],
+        bam_properties.etag,
+        lambda: get_bam_header_blob(blob_service, container_name, bam_filename),
+        get_bam_header_metadata,
+    )
+
     bai_info = {
         "filename": bai_filename,
-        "size": get_size_blob(blob_service, container_name, bai_filename),
-        "created": get_created_time_blob(blob_service, container_name, bai_filename),
+        "size": bai_properties.content_length,
+        "created": bai_properties.last_modified.isoformat(),
         "file_type": "BAI",
     }
 
     return [
-        create_file_metadata(bam_info, bam_header),
-        create_file_metadata(bai_info, bam_header),
+        create_file_metadata(bam_info, header_metadata),
+        create_file_metadata(bai_info, header_metadata),
     ]
 
 
-def import_dlp_realign_bam_server(bam_filepath, storage_directory):
+def import_dlp_realign_bam_server(bam_filepath, storage_directory, header_cache=None):
     if not bam_filepath.startswith(storage_directory):
         raise ValueError(
             "{} not in storage directory {}".format(bam_filepath, storage_directory)
@@ -218,8 +423,6 @@ def import_dlp_realign_bam_server(bam_filepath, storage_directory):
 
     bam_filename = bam_filepath.replace(storage_directory, "").lstrip("/")
 
-    bam_header = get_bam_header_file(bam_filepath)
-
     bam_info = {
         "filename": bam_filename,
         "size": get_size_file(bam_filepath),
@@ -227,6 +430,16 @@ def import_dlp_realign_bam_server(bam_filepath, storage_directory):
         "file_type": "BAM",
     }
 
+    header_metadata = get_header_metadata(
+        header_cache,
+        storage_directory,
+        bam_filename,
+        bam_info["size"],
+        os.path.getmtime(bam_filepath),
+        lambda: get_bam_header_file(bam_filepath),
+        get_bam_header_metadata,
+    )
+
     bai_info = {
         "filename": bam_filename + ".bai",
         "size": get_size_file(bam_filepath + ".bai"),
@@ -235,15 +448,15 @@ def import_dlp_realign_bam_server(bam_filepath, storage_directory):
     }
 
     return [
-        create_file_metadata(bam_info, bam_header),
-        create_file_metadata(bai_info, bam_header),
+        create_file_metadata(bam_info, header_metadata),
+        create_file_metadata(bai_info, header_metadata),
     ]
 
 
-def create_file_metadata(file_info, bam_header):
-    ref_genome = get_bam_ref_genome(bam_header)
-    aligner_name = get_bam_aligner_name(bam_header)
-    bam_header_info = get_bam_header_info(bam_header)
+def create_file_metadata(file_info, header_metadata):
+    ref_genome = header_metadata["ref_genome"]
+    aligner_name = header_metadata["aligner_name"]
+    bam_header_info = header_metadata["header_info"]
 
     return dict(
         dataset_type="BAM",
@@ -280,13 +493,20 @@ if __name__ == "__main__":
     # Get optional arguments
     tag_name = args.get("tag_name")
     analysis_id = args.get("analysis_id")
+    processes = args.get("processes")
+    header_cache_path = args.get("header_cache_path")
 
     # Import DLP BAMs
     import_dlp_realign_bams(
         args["storage_name"],
         args["storage_type"],
-        args["bam_filenames"],
+        args.get("bam_filenames"),
         tantalus_api,
         tag_name=tag_name,
         analysis_id=analysis_id,
+        processes=processes,
+        header_cache_path=header_cache_path,
+        bam_directory=args.get("bam_directory"),
+        bam_glob=args.get("bam_glob", "*.bam"),
+        bulk=args.get("bulk", False),
     )
@@ -48,6 +48,7 @@ def load_brc_fastqs(
     output_dir,
     tantalus_api,
     tag_name=None,
+    bulk=False,
 ):
     # Check for .. in file path
     if ".." in output_dir:
@@ -70,7 +71,7 @@ def load_brc_fastqs(
     fastq_paired_end_check(fastq_file_info)
 
     create_sequence_dataset_models(
-        fastq_file_info, storage_name, tag_name, tantalus_api
+        fastq_file_info, storage_name, tag_name, tantalus_api, bulk=bulk
     )
 
 
@@ -193,4 +194,5 @@ if __name__ == "__main__":
         args["output_dir"],
         tantalus_api,
         tag_name=tag_name,
+        bulk=args.get("bulk", False),
     )
@@ -148,7 +148,7 @@ def get_existing_fastq_data(tantalus_api, dlp_library_id):
     return set(existing_data.keys())
 
 
-def import_gsc_dlp_paired_fastqs(colossus_api, tantalus_api, dlp_library_id, storage, tag_name=None):
+def import_gsc_dlp_paired_fastqs(colossus_api, tantalus_api, dlp_library_id, storage, tag_name=None, bulk=False):
     ''' Import dlp fastq data from the GSC.
     
     Args:
@@ -157,6 +157,7 @@ def import_gsc_dlp_paired_fastqs(colossus_api, tantalus_api, dlp_library_id, sto
         dlp_library_id: library id for the dlp run
         storage: to storage details for transfer
         tag_name: a tag to add to imported data
+        bulk: whether to create the models with bulk requests
 
     '''
 
@@ -322,7 +323,7 @@ def import_gsc_dlp_paired_fastqs(colossus_api, tantalus_api, dlp_library_id, sto
     fastq_paired_end_check(fastq_file_info)
 
     create_sequence_dataset_models(
-        fastq_file_info, storage["name"], tag_name, tantalus_api
+        fastq_file_info, storage["name"], tag_name, tantalus_api, bulk=bulk
     )
 
     logging.info('import succeeded')
@@ -354,5 +355,6 @@ if __name__ == "__main__":
         tantalus_api,
         args["dlp_library_id"],
         storage,
-        tag_name)
+        tag_name,
+        bulk=args.get("bulk", False))
 
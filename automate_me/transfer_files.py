@@ -3,18 +3,45 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+import base64
+import binascii
+import collections
 import datetime
+import functools
 import logging
 import os
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
-from azure.storage.blob import BlockBlobService, ContainerPermissions
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from azure.storage.blob import BlockBlobService, ContainerPermissions, ContentSettings
+from utils.bandwidth import configure_bandwidth_budget, get_bandwidth_budget
+from utils.blobs import (
+    BlobCopyTracker,
+    download_blob_ranges,
+    get_blob_index,
+    get_blob_properties,
+    get_upload_parameters,
+    UPLOAD_SINGLE_PUT_SIZE,
+)
+from utils.checksums import checksum_file, ChecksumReader, StreamingChecksum
 from utils.constants import LOGGING_FORMAT
+from utils.filecopy import copy_file_local
+from utils.journal import FAILED, TransferJournal
+from utils.metrics import TransferMetrics
+from utils.progress import get_transfer_progress, reset_transfer_progress
+from utils.registration import FileInstanceRegistrar
 from utils.runtime_args import parse_runtime_args
 from utils.tantalus import TantalusApi
-from utils.utils import make_dirs
+from utils.utils import as_gb, make_dirs
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 # Set up the root logger
 logging.basicConfig(format=LOGGING_FORMAT, stream=sys.stdout, level=logging.INFO)
@@ -29,6 +56,10 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
+# Returned by a transfer function which found the file already at its
+# destination, so that it isn't counted as bytes moved
+SKIPPED = "skipped"
+
 
 class DataCorruptionError(Exception):
     """An error when corrupt data is found.
@@ -60,75 +91,128 @@ class FileAlreadyExists(Exception):
     pass
 
 
-def _as_gb(num_bytes):
-    return round(num_bytes / (1024.0 * 1024.0 * 1024.0), 2)
-
-
-class TransferProgress(object):
-    def __init__(self):
-        self._start = time.time()
-        self._interval = 10
-        self._last_print = self._start - self._interval * 2
-
-    def print_progress(self, current, total):
-        current_time = time.time()
-        if current_time < self._last_print + self._interval:
-            return
-        self._last_print = current_time
-        elapsed = current_time - self._start
-        percent = "NA"
-        if total > 0:
-            percent = "{:.2f}".format(100.0 * float(current) / total)
-
-        logging.info(
-            "{}/{} ({}%) in {}s".format(
-                _as_gb(current), _as_gb(total), percent, elapsed
-            )
-        )
+def get_new_filepath(storage, file_resource, filename_override=None):
+    """Emulate Tantalus' get_filepath method logic.
 
+    A file instance's filename_override, if it has one, takes the place
+    of the file resource's filename.
+    """
+    filename = filename_override or file_resource["filename"]
 
-def get_new_filepath(storage, file_resource):
-    """Emulate Tantalus' get_filepath method logic."""
     if storage["storage_type"] == "server":
-        return os.path.join(
-            storage["storage_directory"], file_resource["filename"].strip("/")
-        )
+        return os.path.join(storage["storage_directory"], filename.strip("/"))
     elif storage["storage_type"] == "blob":
-        return "/".join(
-            [storage["storage_container"], file_resource["filename"].strip("/")]
-        )
+        return "/".join([storage["storage_container"], filename.strip("/")])
     else:
         # Storage type not supported!
         raise NotImplementedError
 
 
+def get_blob_md5(blob_properties):
+    """Get a blob's Content-MD5 as a hex digest, or None if it has none."""
+    content_md5 = blob_properties.content_settings.content_md5
+
+    if not content_md5:
+        return None
+
+    return binascii.hexlify(base64.b64decode(content_md5)).decode("ascii")
+
+
+def verify_checksums(file_resource, filepath, checksums, expected_md5=None):
+    """Check checksums computed during a transfer against the known MD5.
+
+    Args:
+        file_resource: A dictionary containing the file resource.
+        filepath: The destination filepath, for messages.
+        checksums: A dictionary mapping checksum algorithms to the hex
+            digests computed during the transfer.
+        expected_md5: An optional MD5 hex digest the file should have,
+            e.g. from a blob's Content-MD5. Defaults to the MD5 stored
+            for the file resource in Tantalus. If neither is known,
+            nothing is checked.
+
+    Raises:
+        DataCorruptionError: The MD5 computed doesn't match.
+    """
+    logging.info("checksums for {}: {}".format(filepath, checksums))
+
+    if expected_md5 is None:
+        expected_md5 = file_resource.get("md5")
+
+    if not expected_md5 or "md5" not in checksums:
+        return
+
+    if checksums["md5"] != expected_md5.lower():
+        raise DataCorruptionError(
+            "md5 {} of {} does not match expected md5 {}".format(
+                checksums["md5"], filepath, expected_md5
+            )
+        )
+
+
 class AzureTransfer(object):
     """A class useful for server-blob interactions.
 
     Not so much blob-to-blob interactions in its present form.
     """
 
-    def __init__(self, storage):
+    def __init__(
+        self,
+        storage,
+        max_connections=8,
+        chunk_size=None,
+        small_upload_workers=8,
+        checksums=None,
+        blob_index=None,
+    ):
+        """Connect to a blob storage.
+
+        Args:
+            storage: A dictionary containing the blob storage, with its
+                credentials.
+            max_connections: The number of concurrent ranged GETs used
+                when downloading a blob.
+            chunk_size: An optional size in bytes for each ranged GET.
+                Defaults to a size chosen from the blob size.
+            small_upload_workers: The number of small files uploaded at
+                once. Larger files are uploaded one at a time, with
+                parameters chosen from their size.
+            checksums: An optional list of checksum algorithms (e.g.
+                ["md5", "crc32"]) to compute as data is transferred. The
+                MD5, if computed, is verified.
+            blob_index: An optional BlobIndex of the storage's
+                container, used to decide whether uploads already exist
+                without requesting each blob's properties.
+        """
+        self._storage_account = storage["storage_account"]
+        self._storage_key = storage["credentials"]["storage_key"]
         self.block_blob_service = BlockBlobService(
-            account_name=storage["storage_account"],
-            account_key=storage["credentials"]["storage_key"],
+            account_name=self._storage_account, account_key=self._storage_key
+        )
+        self.max_connections = max_connections
+        self.chunk_size = chunk_size
+        self.checksums = checksums
+        self.blob_index = blob_index
+
+        self._upload_blob_services = {}
+        self._upload_blob_services_lock = threading.Lock()
+        self._upload_connection_throughput = None
+        self._small_upload_executor = ThreadPoolExecutor(
+            max_workers=small_upload_workers
         )
-        self.block_blob_service.MAX_BLOCK_SIZE = 64 * 1024 * 1024
 
-    def download_from_blob(self, file_instance, to_storage, tantalus_api):
+    def download_from_blob(self, file_instance, to_storage):
         """ Transfer a file from blob to a server.
 
-        This should be called on the from server.
+        This should be called on the from server. Returns SKIPPED if the
+        file is already on the server.
         """
 
         cloud_filepath = file_instance["filepath"]
         cloud_container, cloud_blobname = cloud_filepath.split("/", 1)
         assert cloud_container == file_instance["storage"]["storage_container"]
 
-        # Get the file resource associated with the file instance
-        file_resource = tantalus_api.get(
-            "file_resource", id=file_instance["file_resource"]
-        )
+        file_resource = file_instance["file_resource"]
 
         local_filepath = get_new_filepath(to_storage, file_resource)
 
@@ -142,43 +226,73 @@ class AzureTransfer(object):
             )
             raise FileDoesNotExist(error_message)
 
+        blob_properties = self.block_blob_service.get_blob_properties(
+            cloud_container, cloud_blobname
+        ).properties
+
         if os.path.isfile(local_filepath):
-            if self._check_file_same_blob(file_resource, cloud_container, cloud_blobname):
-                return
+            if self._check_file_same_blob(file_resource, blob_properties):
+                return SKIPPED
 
             error_message = "target file {filepath} already exists on {storage}".format(
                 filepath=local_filepath, storage=to_storage["name"]
             )
             raise FileAlreadyExists(error_message)
 
-        self.block_blob_service.get_blob_to_path(
+        if self.checksums:
+            checksum = StreamingChecksum(self.checksums)
+        else:
+            checksum = None
+
+        # Download next to the target and move it into place once
+        # complete, since the preallocated file has the right size long
+        # before it has the right contents
+        partial_filepath = local_filepath + ".part"
+
+        download_blob_ranges(
+            self.block_blob_service,
             cloud_container,
             cloud_blobname,
-            local_filepath,
-            progress_callback=TransferProgress().print_progress,
-            max_connections=1,
+            blob_properties.content_length,
+            partial_filepath,
+            max_connections=self.max_connections,
+            chunk_size=self.chunk_size,
+            progress_callback=get_transfer_progress().get_callback(
+                file_resource["id"]
+            ),
+            checksum=checksum,
         )
 
-        os.chmod(local_filepath, 0o444)
+        if checksum is not None:
+            try:
+                verify_checksums(
+                    file_resource,
+                    local_filepath,
+                    checksum.hexdigests(),
+                    expected_md5=get_blob_md5(blob_properties),
+                )
+            except DataCorruptionError:
+                os.remove(partial_filepath)
+                raise
+
+        os.chmod(partial_filepath, 0o444)
+        os.rename(partial_filepath, local_filepath)
 
-    def _check_file_same_blob(self, file_resource, container, blobname):
-        properties = self.block_blob_service.get_blob_properties(container, blobname)
-        blobsize = properties.properties.content_length
-        if file_resource["size"] != blobsize:
+    def _check_file_same_blob(self, file_resource, blob_properties):
+        if file_resource["size"] != blob_properties.content_length:
             return False
         return True
 
-    def upload_to_blob(self, file_instance, to_storage, tantalus_api):
+    def upload_to_blob(self, file_instance, to_storage):
         """Transfer a file from a server to blob.
 
-        This should be called on the from server.
+        This should be called on the from server. Files small enough for
+        a single put are uploaded in the background, in which case a
+        Future for the upload is returned. Returns SKIPPED if the blob
+        already exists.
         """
         local_filepath = file_instance["filepath"]
-
-        # Get the file resource associated with the file instance
-        file_resource = tantalus_api.get(
-            "file_resource", id=file_instance["file_resource"]
-        )
+        file_resource = file_instance["file_resource"]
 
         cloud_filepath = get_new_filepath(to_storage, file_resource)
         cloud_container, cloud_blobname = cloud_filepath.split("/", 1)
@@ -192,34 +306,186 @@ class AzureTransfer(object):
             )
             raise FileDoesNotExist(error_message)
 
-        if self.block_blob_service.exists(cloud_container, cloud_blobname):
-            if self._check_file_same_blob(
-                file_resource, cloud_container, cloud_blobname
-            ):
-                return
+        blob_properties = get_blob_properties(
+            self.block_blob_service, cloud_container, cloud_blobname, self.blob_index
+        )
+
+        if blob_properties is not None:
+            if self._check_file_same_blob(file_resource, blob_properties):
+                return SKIPPED
 
             error_message = "target file {filepath} already exists on {storage}".format(
                 filepath=cloud_filepath, storage=to_storage["name"]
             )
             raise FileAlreadyExists(error_message)
 
-        self.block_blob_service.create_blob_from_path(
+        upload_parameters = get_upload_parameters(
+            os.path.getsize(local_filepath),
+            connection_throughput=self._upload_connection_throughput,
+        )
+
+        # Small files share a pool rather than each getting their own
+        # set of connections
+        if upload_parameters["single_put"]:
+            return self._small_upload_executor.submit(
+                self._create_blob_from_path,
+                file_resource,
+                cloud_container,
+                cloud_blobname,
+                local_filepath,
+                upload_parameters,
+            )
+
+        self._create_blob_from_path(
+            file_resource,
             cloud_container,
             cloud_blobname,
             local_filepath,
-            progress_callback=TransferProgress().print_progress,
-            max_connections=16,
-            timeout=10 * 60 * 64,
+            upload_parameters,
+        )
+
+    def _get_upload_blob_service(self, block_size):
+        """Get a BlockBlobService which uploads with a block size.
+
+        The block size is an attribute of the service, so each block
+        size gets its own service to keep concurrent uploads apart.
+        """
+        with self._upload_blob_services_lock:
+            if block_size not in self._upload_blob_services:
+                block_blob_service = BlockBlobService(
+                    account_name=self._storage_account, account_key=self._storage_key
+                )
+                block_blob_service.MAX_SINGLE_PUT_SIZE = UPLOAD_SINGLE_PUT_SIZE
+
+                if block_size is not None:
+                    block_blob_service.MAX_BLOCK_SIZE = block_size
+
+                self._upload_blob_services[block_size] = block_blob_service
+
+            return self._upload_blob_services[block_size]
+
+    def _create_blob_from_path(
+        self, file_resource, container, blobname, filepath, upload_parameters
+    ):
+        block_blob_service = self._get_upload_blob_service(
+            upload_parameters["block_size"]
+        )
+
+        # The SDK reports progress as each block is sent, which is where
+        # uploads are throttled
+        progress_callback = get_bandwidth_budget().throttle_progress(
+            get_transfer_progress().get_callback(file_resource["id"])
         )
 
+        start = time.time()
+
+        if self.checksums:
+            self._create_blob_from_path_checksummed(
+                block_blob_service,
+                file_resource,
+                container,
+                blobname,
+                filepath,
+                progress_callback=progress_callback,
+                max_connections=upload_parameters["max_connections"],
+                timeout=upload_parameters["timeout"],
+            )
+        else:
+            block_blob_service.create_blob_from_path(
+                container,
+                blobname,
+                filepath,
+                progress_callback=progress_callback,
+                max_connections=upload_parameters["max_connections"],
+                timeout=upload_parameters["timeout"],
+            )
+
+        # Small uploads are dominated by latency, so only block uploads
+        # tell us anything about throughput
+        if not upload_parameters["single_put"]:
+            self._record_upload_throughput(
+                os.path.getsize(filepath),
+                time.time() - start,
+                upload_parameters["max_connections"],
+            )
+
+    def _create_blob_from_path_checksummed(
+        self, block_blob_service, file_resource, container, blobname, filepath, **kwargs
+    ):
+        """Upload a file, checksumming it as the upload reads it.
+
+        The MD5 is checked against the one stored in Tantalus, if any,
+        and then saved as the blob's Content-MD5. A blob which doesn't
+        match is deleted, so a retry doesn't mistake it for a finished
+        upload.
+        """
+        checksum = StreamingChecksum(self.checksums)
+
+        with open(filepath, "rb") as f:
+            block_blob_service.create_blob_from_stream(
+                container,
+                blobname,
+                ChecksumReader(f, checksum),
+                count=os.path.getsize(filepath),
+                **kwargs
+            )
+
+        checksums = checksum.hexdigests()
+
+        try:
+            verify_checksums(file_resource, blobname, checksums)
+        except DataCorruptionError:
+            block_blob_service.delete_blob(container, blobname)
+            raise
+
+        if "md5" in checksums:
+            block_blob_service.set_blob_properties(
+                container,
+                blobname,
+                content_settings=ContentSettings(
+                    content_type="application/octet-stream",
+                    content_md5=base64.b64encode(
+                        binascii.unhexlify(checksums["md5"])
+                    ).decode("ascii"),
+                ),
+            )
+
+    def _record_upload_throughput(self, num_bytes, seconds, max_connections):
+        """Fold a finished upload into the per-connection throughput."""
+        connection_throughput = num_bytes / max(seconds, 1e-3) / max_connections
+
+        with self._upload_blob_services_lock:
+            if self._upload_connection_throughput is None:
+                self._upload_connection_throughput = connection_throughput
+            else:
+                self._upload_connection_throughput = (
+                    0.5 * self._upload_connection_throughput
+                    + 0.5 * connection_throughput
+                )
 
-def blob_to_blob_transfer_closure(source_storage, destination_storage):
+
+def blob_to_blob_transfer_closure(
+    source_storage, destination_storage, blob_index=None
+):
     """Returns a function for transfering blobs between Azure containers.
 
     Note that this will *not* create new containers that don't already
     exist. This is a useful note because for development the container
     names are changed to "{container name}-test", and these "test
     containers" are unlikely to exist.
+
+    Copies run server-side, so the transfer function starts a copy and
+    returns a Future which resolves once the copy has succeeded, or
+    SKIPPED if the destination blob already exists. The
+    BlobCopyTracker polling those copies is available as the function's
+    copy_tracker attribute.
+
+    Copies aren't checksummed. The data never passes through this
+    process, and Copy Blob carries the source's Content-MD5 over, so
+    comparing Content-MD5s would check nothing.
+
+    If a BlobIndex of the destination container is given, whether each
+    blob already exists is looked up in it.
     """
     # Start BlockBlobService for source and destination accounts
     source_account = BlockBlobService(
@@ -231,6 +497,10 @@ def blob_to_blob_transfer_closure(source_storage, destination_storage):
         account_key=destination_storage["credentials"]["storage_key"],
     )
 
+    copy_tracker = BlobCopyTracker(
+        destination_account, destination_storage["storage_container"]
+    )
+
     # Get a shared access signature for the source account so that we
     # can read its private files
     shared_access_sig = source_account.generate_container_shared_access_signature(
@@ -259,22 +529,35 @@ def blob_to_blob_transfer_closure(source_storage, destination_storage):
             raise FileDoesNotExist(error_message)
 
         # Copypasta validation from AzureTransfer.upload_to_blob
-        if destination_account.exists(
-            destination_storage["storage_container"], blobname
-        ):
+        destination_blob_properties = get_blob_properties(
+            destination_account,
+            destination_storage["storage_container"],
+            blobname,
+            blob_index,
+        )
+
+        if destination_blob_properties is not None:
             # Check if the file already exist. If the file does already
             # exist, don't re-transfer this file. If the file does exist
             # but has a different size, then raise an exception.
 
-            # Size check
-            destination_blob_size = destination_account.get_blob_properties(
-                container_name=destination_storage["storage_container"],
-                blob_name=blobname,
-            )
+            # A copy from an earlier run may still be in progress
+            if (
+                destination_blob_properties.copy is not None
+                and destination_blob_properties.copy.status == "pending"
+            ):
+                return copy_tracker.track(
+                    blobname,
+                    destination_blob_properties.copy,
+                    source_file["file_resource"]["size"],
+                )
 
-            if source_file["size"] == destination_blob_size:
+            if (
+                source_file["file_resource"]["size"]
+                == destination_blob_properties.content_length
+            ):
                 # Don't retransfer
-                return
+                return SKIPPED
             else:
                 # Raise an exception and report that a blob with this
                 # name already exists!
@@ -291,20 +574,31 @@ def blob_to_blob_transfer_closure(source_storage, destination_storage):
             sas_token=shared_access_sig,
         )
 
-        destination_account.copy_blob(
+        copy_properties = destination_account.copy_blob(
             container_name=destination_storage["storage_container"],
             blob_name=blobname,
             copy_source=source_sas_url,
         )
 
+        return copy_tracker.track(
+            blobname, copy_properties, source_file["file_resource"]["size"]
+        )
+
+    transfer_function.copy_tracker = copy_tracker
+
     # Return the transfer function
     return transfer_function
 
 
 def check_file_same_local(file_resource, filepath):
-    # TODO: define 'size' for folder
+    """Check that a local file or folder matches its file resource.
+
+    Files are compared by size. Folders have no size of their own, so
+    they only have to exist; rsync_folder checks their contents against
+    the source.
+    """
     if file_resource["is_folder"]:
-        return True
+        return os.path.isdir(filepath)
 
     if file_resource["size"] != os.path.getsize(filepath):
         return False
@@ -312,39 +606,419 @@ def check_file_same_local(file_resource, filepath):
     return True
 
 
-def rsync_file(file_instance, to_storage, tantalus_api):
-    """ Rsync a single file from one storage to another
+# Reuse one SSH connection per source host across rsync runs
+RSYNC_SSH_COMMAND = (
+    "ssh -o ControlMaster=auto -o ControlPath={} -o ControlPersist=300".format(
+        os.path.join(tempfile.gettempdir(), "transfer_files_ssh_%r@%h:%p")
+    )
+)
+
+
+def get_rsync_location(storage, to_storage, filepath):
+    """Get an rsync location for a path on a storage.
+
+    Paths on the same server as the destination are used as is.
     """
+    if storage["server_ip"] == to_storage["server_ip"]:
+        return filepath
 
-    # Get the file resource associated with the file instance
-    file_resource = tantalus_api.get("file_resource", id=file_instance["file_resource"])
+    return storage["username"] + "@" + storage["server_ip"] + ":" + filepath
 
-    local_filepath = get_new_filepath(to_storage, file_resource)
 
-    remote_filepath = file_instance["filepath"]
+def run_rsync(subprocess_cmd):
+    """Run rsync, sending its output to the log a line at a time.
 
-    if file_instance["file_resource"]["is_folder"]:
-        local_filepath = local_filepath + "/"
-        remote_filepath = remote_filepath + "/"
+    Returns:
+        The exit status of rsync.
+    """
+    logging.info(" ".join(subprocess_cmd))
 
-    if os.path.isfile(local_filepath):
-        if check_file_same_local(file_instance["file_resource"], local_filepath):
-            return
-        error_message = "target file {filepath} already exists on {storage} with different size".format(
-            filepath=local_filepath, storage=to_storage["name"]
+    process = subprocess.Popen(
+        subprocess_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+
+    with process.stdout:
+        for line in iter(process.stdout.readline, b""):
+            # Progress updates are separated by carriage returns, so
+            # only log the latest one
+            line = line.decode("utf-8", "replace").rstrip().split("\r")[-1]
+
+            if line:
+                logging.info(line)
+
+    return process.wait()
+
+
+def get_rsync_bwlimit_args(num_parts=1):
+    """Get the rsync arguments limiting a run to its bandwidth share.
+
+    The share is fixed when rsync starts, so a run that spans a change
+    in the bandwidth schedule keeps its starting limit. A transfer made
+    of num_parts rsync runs at once gives each run part of its share.
+    """
+    share_kbps = get_bandwidth_budget().get_share_kbps(num_parts=num_parts)
+
+    if share_kbps is None:
+        return []
+
+    return ["--bwlimit={}".format(share_kbps)]
+
+
+def rsync_files_from(
+    source_location, destination, relative_filepaths, bwlimit_args=None
+):
+    """Rsync a list of files under one directory in a single run.
+
+    Parent directories must already exist at the destination, so only
+    files are sent.
+
+    Args:
+        source_location: The rsync location of the source directory,
+            ending with a slash.
+        destination: The destination directory, ending with a slash.
+        relative_filepaths: Paths of the files relative to the source
+            directory.
+        bwlimit_args: The bandwidth limit arguments for a run which is
+            part of a transfer that has already reserved a bandwidth
+            share. By default, the run reserves a share of its own.
+
+    Returns:
+        The exit status of rsync.
+    """
+    bandwidth_budget = get_bandwidth_budget()
+
+    if bwlimit_args is None:
+        bandwidth_budget.start_transfer()
+
+    try:
+        with tempfile.NamedTemporaryFile("w", suffix=".files") as files_from:
+            for relative_filepath in relative_filepaths:
+                files_from.write(relative_filepath + "\n")
+
+            files_from.flush()
+
+            subprocess_cmd = [
+                "rsync",
+                "--files-from=" + files_from.name,
+                "--no-implied-dirs",
+                "--chmod=F444",
+                "--times",
+                "--copy-links",
+                "-e",
+                RSYNC_SSH_COMMAND,
+            ]
+            if bwlimit_args is None:
+                subprocess_cmd += get_rsync_bwlimit_args()
+            else:
+                subprocess_cmd += bwlimit_args
+
+            subprocess_cmd += [source_location, destination]
+
+            return run_rsync(subprocess_cmd)
+    finally:
+        if bwlimit_args is None:
+            bandwidth_budget.finish_transfer()
+
+
+def _rsync_batch(entries, to_storage, checksums=None):
+    """Rsync planned files from one source storage in a single run.
+
+    If checksums are enabled, every file which arrived with the expected
+    size is then checksummed and checked against its MD5 in Tantalus.
+
+    Returns:
+        The files which arrived with the expected size (and checksums),
+        as plan entries. Files which didn't are removed so they can be
+        sent again.
+    """
+    storage = entries[0]["file_instance"]["storage"]
+
+    for entry in entries:
+        make_dirs(os.path.dirname(entry["filepath"]))
+
+    returncode = rsync_files_from(
+        get_rsync_location(storage, to_storage, storage["storage_directory"] + "/"),
+        to_storage["storage_directory"] + "/",
+        [entry["file_resource"]["filename"].strip("/") for entry in entries],
+    )
+
+    arrived = []
+
+    for entry in entries:
+        if not os.path.isfile(entry["filepath"]):
+            continue
+
+        if check_file_same_local(entry["file_resource"], entry["filepath"]):
+            arrived.append(entry)
+        else:
+            os.remove(entry["filepath"])
+
+    if checksums:
+        # Files are hashed in the background all at once
+        checksum_futures = [
+            checksum_file(entry["filepath"], checksums) for entry in arrived
+        ]
+        verified = []
+
+        for entry, checksum_future in zip(arrived, checksum_futures):
+            try:
+                verify_checksums(
+                    entry["file_resource"], entry["filepath"], checksum_future.result()
+                )
+            except DataCorruptionError:
+                logging.exception("batched file failed its checksum")
+                os.remove(entry["filepath"])
+                continue
+
+            verified.append(entry)
+
+        arrived = verified
+
+    logging.info(
+        "batched rsync from {} exited with status {}: {} of {} files transferred".format(
+            storage["name"], returncode, len(arrived), len(entries)
         )
-        raise FileAlreadyExists(error_message)
+    )
 
-    if file_instance["storage"]["server_ip"] == to_storage["server_ip"]:
-        remote_location = remote_filepath
-    else:
-        remote_location = (
-            file_instance["storage"]["username"]
-            + "@"
-            + file_instance["storage"]["server_ip"]
-            + ":"
-            + remote_filepath
+    return arrived
+
+
+def rsync_files_batched(plan, to_storage, batch_size=1000, checksums=None):
+    """Rsync the files in a plan with one rsync run per batch.
+
+    Files are grouped by source storage and sent in batches with
+    rsync --files-from, after which every file in the batch is checked
+    for size, and for checksums if they are enabled. Only files which
+    don't exist at their destination and whose path relative to the
+    storage directory is the same on both storages are batched.
+
+    Nothing is registered here. Files transferred this way are found
+    already in place when the plan is executed with rsync_file, which
+    also sends whatever the batches missed, so the executor counts them
+    as skipped.
+
+    Returns:
+        A dictionary containing the files and bytes the batches
+        transferred ("files", "bytes") and the seconds they took
+        ("seconds"), for the metrics summary.
+    """
+    batches = collections.defaultdict(list)
+
+    for entry in plan:
+        file_instance = entry["file_instance"]
+        storage = file_instance["storage"]
+
+        if entry["file_resource"]["is_folder"] or os.path.exists(entry["filepath"]):
+            continue
+
+        relative_filepath = os.path.relpath(
+            file_instance["filepath"], storage["storage_directory"]
+        )
+
+        if relative_filepath != entry["file_resource"]["filename"].strip("/"):
+            continue
+
+        batches[storage["name"]].append(entry)
+
+    num_batched = sum(len(entries) for entries in batches.values())
+    transferred = []
+    start_time = time.time()
+
+    for entries in batches.values():
+        for start in range(0, len(entries), batch_size):
+            transferred.extend(
+                _rsync_batch(
+                    entries[start : start + batch_size],
+                    to_storage,
+                    checksums=checksums,
+                )
+            )
+
+    logging.info(
+        "batched rsync transferred {} of {} files, {} left for per-file rsync".format(
+            len(transferred), num_batched, len(plan) - len(transferred)
+        )
+    )
+
+    return dict(
+        files=len(transferred),
+        bytes=sum(entry["size"] or 0 for entry in transferred),
+        seconds=round(time.time() - start_time, 3),
+    )
+
+
+def get_folder_manifest(location):
+    """Get the sizes and modification times of the files in a folder.
+
+    Uses rsync's listing, so the folder can be on a remote server.
+
+    Args:
+        location: The rsync location of the folder.
+
+    Returns:
+        A dictionary mapping paths relative to the folder to (size,
+        mtime) tuples, with mtimes in whole seconds.
+    """
+    output = subprocess.check_output(
+        [
+            "rsync",
+            "-r",
+            "--list-only",
+            "--no-human-readable",
+            "--copy-links",
+            "-e",
+            RSYNC_SSH_COMMAND,
+            location.rstrip("/") + "/",
+        ]
+    )
+
+    manifest = {}
+
+    for line in output.decode("utf-8").splitlines():
+        # Lines look like "-rw-r--r--  1234 2018/01/31 12:34:56 path"
+        permissions, size, date, time_of_day, path = line.split(None, 4)
+
+        if not permissions.startswith("-"):
+            continue
+
+        mtime = time.mktime(
+            time.strptime(date + " " + time_of_day, "%Y/%m/%d %H:%M:%S")
+        )
+        manifest[path] = (int(size.replace(",", "")), int(mtime))
+
+    return manifest
+
+
+def get_local_folder_manifest(folderpath):
+    """Get the manifest of a local folder, as in get_folder_manifest."""
+    manifest = {}
+
+    for dirpath, _, filenames in os.walk(folderpath, followlinks=True):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            path = os.path.relpath(filepath, folderpath)
+
+            manifest[path] = (
+                os.path.getsize(filepath),
+                int(os.path.getmtime(filepath)),
+            )
+
+    return manifest
+
+
+def shard_manifest(manifest, num_shards):
+    """Split the paths in a manifest into shards of about equal size.
+
+    Returns:
+        A list of at most num_shards non-empty lists of paths.
+    """
+    shards = [[] for _ in range(num_shards)]
+    shard_sizes = [0] * num_shards
+
+    # Give each file, largest first, to the smallest shard so far
+    for path, (size, _) in sorted(
+        manifest.items(), key=lambda item: item[1][0], reverse=True
+    ):
+        index = shard_sizes.index(min(shard_sizes))
+        shards[index].append(path)
+        shard_sizes[index] += size
+
+    return [shard for shard in shards if shard]
+
+
+def rsync_folder(file_instance, to_storage, num_shards=4):
+    """Rsync a folder file resource in parallel shards.
+
+    The source folder is listed into a manifest and only the files
+    missing or different at the destination are sent, split into shards
+    of about equal size which are rsynced at once. The destination is
+    then checked against the manifest, so rerunning a failed transfer
+    only sends what is still different. Returns SKIPPED if nothing had
+    to be sent.
+    """
+    file_resource = file_instance["file_resource"]
+
+    local_folderpath = get_new_filepath(to_storage, file_resource) + "/"
+    remote_location = get_rsync_location(
+        file_instance["storage"], to_storage, file_instance["filepath"] + "/"
+    )
+
+    manifest = get_folder_manifest(remote_location)
+    local_manifest = get_local_folder_manifest(local_folderpath)
+
+    changed = {
+        path: size_mtime
+        for path, size_mtime in manifest.items()
+        if local_manifest.get(path) != size_mtime
+    }
+
+    logging.info(
+        "{} of {} files in {} to send".format(
+            len(changed), len(manifest), file_resource["filename"]
+        )
+    )
+
+    # Directories are created up front and left writable, so that
+    # shards can't race on them and reruns can write into them
+    for path in changed:
+        make_dirs(os.path.dirname(os.path.join(local_folderpath, path)))
+
+    make_dirs(local_folderpath)
+
+    shards = shard_manifest(changed, num_shards)
+
+    if shards:
+        # The shards split one bandwidth share between them
+        bandwidth_budget = get_bandwidth_budget()
+        bandwidth_budget.start_transfer()
+
+        executor = ThreadPoolExecutor(max_workers=len(shards))
+
+        try:
+            bwlimit_args = get_rsync_bwlimit_args(num_parts=len(shards))
+
+            returncodes = list(
+                executor.map(
+                    lambda shard: rsync_files_from(
+                        remote_location, local_folderpath, shard, bwlimit_args
+                    ),
+                    shards,
+                )
+            )
+        finally:
+            executor.shutdown(wait=True)
+            bandwidth_budget.finish_transfer()
+
+        logging.info(
+            "rsync of {} exited with statuses {}".format(
+                file_resource["filename"], returncodes
+            )
+        )
+
+    local_manifest = get_local_folder_manifest(local_folderpath)
+
+    mismatched = [
+        path for path in manifest if local_manifest.get(path) != manifest[path]
+    ]
+
+    if mismatched:
+        error_message = "transfer to {filepath} on {storage} failed for {num} of {total} files, e.g. {example}".format(
+            filepath=local_folderpath,
+            storage=to_storage["name"],
+            num=len(mismatched),
+            total=len(manifest),
+            example=mismatched[0],
         )
+        raise Exception(error_message)
+
+    if not changed:
+        return SKIPPED
+
+
+def _rsync_remote_file(file_instance, to_storage, remote_filepath, local_filepath):
+    remote_location = get_rsync_location(
+        file_instance["storage"], to_storage, remote_filepath
+    )
 
     make_dirs(os.path.dirname(local_filepath))
 
@@ -352,153 +1026,1222 @@ def rsync_file(file_instance, to_storage, tantalus_api):
         "rsync",
         "--progress",
         # '--info=progress2',
-        "--chmod=D555",
         "--chmod=F444",
         "--times",
         "--copy-links",
+        "-e",
+        RSYNC_SSH_COMMAND,
         remote_location,
         local_filepath,
     ]
 
-    if file_instance["file_resource"]["is_folder"]:
-        subprocess_cmd.insert(1, "-r")
+    bandwidth_budget = get_bandwidth_budget()
+    bandwidth_budget.start_transfer()
+
+    try:
+        subprocess_cmd[1:1] = get_rsync_bwlimit_args()
+        returncode = run_rsync(subprocess_cmd)
+    finally:
+        bandwidth_budget.finish_transfer()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, subprocess_cmd)
+
+
+def rsync_file(
+    file_instance, to_storage, checksums=None, folder_shards=4, local_hardlinks=False
+):
+    """ Rsync a single file from one storage to another
+
+    rsync doesn't expose the bytes it moves, so if checksums are enabled
+    the destination file is checksummed once rsync is done. Folders are
+    sent with rsync_folder in folder_shards shards.
+
+    Files on the same server as the destination are copied natively
+    with copy_file_local instead, hardlinking them if local_hardlinks is
+    set and both storages are on the same filesystem. If checksums are
+    enabled, these files are checksummed as they are copied.
+
+    Returns SKIPPED if the file is already at the destination, e.g.
+    because rsync_files_batched sent it.
+    """
+    file_resource = file_instance["file_resource"]
+
+    if file_resource["is_folder"]:
+        return rsync_folder(file_instance, to_storage, num_shards=folder_shards)
+
+    local_filepath = get_new_filepath(to_storage, file_resource)
+
+    remote_filepath = file_instance["filepath"]
+
+    if os.path.isfile(local_filepath):
+        if check_file_same_local(file_resource, local_filepath):
+            return SKIPPED
+        error_message = "target file {filepath} already exists on {storage} with different size".format(
+            filepath=local_filepath, storage=to_storage["name"]
+        )
+        raise FileAlreadyExists(error_message)
+
+    checksum = None
+
+    if file_instance["storage"]["server_ip"] == to_storage["server_ip"]:
+        if checksums:
+            checksum = StreamingChecksum(checksums)
 
-    sys.stdout.flush()
-    sys.stderr.flush()
-    subprocess.check_call(subprocess_cmd, stdout=sys.stdout, stderr=sys.stderr)
+        method = copy_file_local(
+            remote_filepath, local_filepath, hardlink=local_hardlinks, checksum=checksum
+        )
+        logging.info(
+            "copied {} to {} with {}".format(remote_filepath, local_filepath, method)
+        )
+    else:
+        _rsync_remote_file(file_instance, to_storage, remote_filepath, local_filepath)
 
-    if not check_file_same_local(file_instance["file_resource"], local_filepath):
+    if not check_file_same_local(file_resource, local_filepath):
         error_message = "transfer to {filepath} on {storage} failed".format(
             filepath=local_filepath, storage=to_storage["name"]
         )
         raise Exception(error_message)
 
-
-def get_file_transfer_function(from_storage, to_storage):
+    if checksums:
+        if checksum is not None:
+            hexdigests = checksum.hexdigests()
+        else:
+            hexdigests = checksum_file(local_filepath, checksums).result()
+
+        try:
+            verify_checksums(file_resource, local_filepath, hexdigests)
+        except DataCorruptionError:
+            os.remove(local_filepath)
+            raise
+
+
+def get_file_transfer_function(
+    from_storage,
+    to_storage,
+    download_connections=8,
+    checksums=None,
+    folder_shards=4,
+    blob_index=None,
+    local_hardlinks=False,
+):
     if from_storage["storage_type"] == "blob" and to_storage["storage_type"] == "blob":
-        return blob_to_blob_transfer_closure(from_storage, to_storage)
+        return blob_to_blob_transfer_closure(
+            from_storage, to_storage, blob_index=blob_index
+        )
     elif (
         from_storage["storage_type"] == "server"
         and to_storage["storage_type"] == "blob"
     ):
-        return AzureTransfer(to_storage).upload_to_blob
+        return AzureTransfer(
+            to_storage, checksums=checksums, blob_index=blob_index
+        ).upload_to_blob
     elif (
         from_storage["storage_type"] == "blob"
         and to_storage["storage_type"] == "server"
     ):
-        return AzureTransfer(from_storage).download_from_blob
+        return AzureTransfer(
+            from_storage, max_connections=download_connections, checksums=checksums
+        ).download_from_blob
     elif (
         from_storage["storage_type"] == "server"
         and to_storage["storage_type"] == "server"
     ):
-        return rsync_file
+        return functools.partial(
+            rsync_file,
+            checksums=checksums,
+            folder_shards=folder_shards,
+            local_hardlinks=local_hardlinks,
+        )
 
 
-def transfer_files(tag_name, from_storage_name, to_storage_name):
-    """ Transfer a set of files
+def get_storage_names(tantalus_api):
+    """Get a dictionary mapping storage IDs to storage names."""
+    return {storage["id"]: storage["name"] for storage in tantalus_api.list("storage")}
+
+
+def get_tagged_file_resources(tantalus_api, tag_names):
+    """Get the file resources of all datasets and results with some tags.
+
+    File resources shared between datasets or tags are only returned
+    once. Sequence dataset file resources are listed a dataset at a time
+    rather than requested one by one. Results file resources are
+    requested by ID, skipping any already found.
     """
-    # Connect to the Tantalus API (this requires appropriate environment
-    # variables defined)
-    tantalus_api = TantalusApi()
+    file_resources = collections.OrderedDict()
 
-    # Get the storage details, sans credentials
-    to_storage = tantalus_api.get("storage", name=to_storage_name)
-    from_storage = tantalus_api.get("storage", name=from_storage_name)
+    for tag_name in tag_names:
+        _add_tagged_file_resources(tantalus_api, tag_name, file_resources)
 
-    # For blob storages, get credentials for each storage by
-    # transforming from credential ID to the credential itself
-    if to_storage["storage_type"] == "blob":
-        to_storage["credentials"] = tantalus_api.get(
-            "storage_azure_blob_credentials", id=to_storage["credentials"]
-        )
+    return list(file_resources.values())
+
+
+def _add_listed_file_resources(
+    tantalus_api, file_resource_ids, file_resources, **filters
+):
+    """Add file resources to a dictionary by listing them all at once.
+
+    Only file resources with the given IDs are added from the listing,
+    and anything the listing missed is fetched individually.
+    """
+    file_resource_ids = set(file_resource_ids)
+
+    if all(
+        file_resource_id in file_resources for file_resource_id in file_resource_ids
+    ):
+        return
 
-    if from_storage["storage_type"] == "blob":
-        from_storage["credentials"] = tantalus_api.get(
-            "storage_azure_blob_credentials", id=from_storage["credentials"]
+    for file_resource in tantalus_api.list("file_resource", **filters):
+        if file_resource["id"] in file_resource_ids:
+            file_resources.setdefault(file_resource["id"], file_resource)
+
+    for file_resource_id in file_resource_ids:
+        if file_resource_id not in file_resources:
+            file_resources[file_resource_id] = tantalus_api.get(
+                "file_resource", id=file_resource_id
+            )
+
+
+def _add_tagged_file_resources(tantalus_api, tag_name, file_resources):
+    for dataset in tantalus_api.list("sequence_dataset", tags__name=tag_name):
+        _add_listed_file_resources(
+            tantalus_api,
+            dataset["file_resources"],
+            file_resources,
+            sequencedataset__id=dataset["id"],
         )
 
-    f_transfer = get_file_transfer_function(from_storage, to_storage)
+    for results in tantalus_api.list("results", tags__name=tag_name):
+        for file_resource_id in results["file_resources"]:
+            if file_resource_id not in file_resources:
+                file_resources[file_resource_id] = tantalus_api.get(
+                    "file_resource", id=file_resource_id
+                )
+
 
-    datasets = tantalus_api.list("sequence_dataset", tags__name=tag_name)
-    results = tantalus_api.list("results", tags__name=tag_name)
+def build_transfer_plan(
+    tantalus_api, tag_names, from_storage, to_storage, relay_storage=None
+):
+    """Resolve everything needed to transfer some tags up front.
+
+    Args:
+        tantalus_api: A TantalusApi instance.
+        tag_names: A list of the names of the tags whose datasets and
+            results to transfer.
+        from_storage: A dictionary containing the source storage.
+        to_storage: A dictionary containing the destination storage.
+        relay_storage: An optional dictionary containing a storage to
+            read the files from instead of the source storage. The files
+            are planned from the source storage, since they may still be
+            on their way to the relay storage (see Relay).
+
+    Returns:
+        A list of planned transfers. Each planned transfer is a
+        dictionary containing the file resource, the source file
+        instance (with its file resource and storage nested in), the
+        destination filepath, and the size of the file.
+
+    Raises:
+        FileDoesNotExist: A file resource has no file instance on the
+            source storage.
+    """
+    storage_names = get_storage_names(tantalus_api)
 
-    for dataset in list(datasets) + list(results):
-        for file_resource_id in dataset["file_resources"]:
-            # Get the file resource corresponding to the ID
-            file_resource = tantalus_api.get("file_resource", id=file_resource_id)
+    # Credentials never belong in the plan
+    from_storage = {
+        key: value for key, value in from_storage.items() if key != "credentials"
+    }
 
-            storage_names = []
+    if relay_storage is None:
+        read_storage = from_storage
+    else:
+        read_storage = {
+            key: value for key, value in relay_storage.items() if key != "credentials"
+        }
 
-            for file_instance in file_resource["file_instances"]:
-                storage_id = file_instance["storage"]["id"]
+    plan = []
 
-                storage_name = tantalus_api.get("storage", id=int(storage_id))["name"]
-                storage_names.append(storage_name)
+    for file_resource in get_tagged_file_resources(tantalus_api, tag_names):
+        instance_storage_names = {
+            storage_names[int(file_instance["storage"]["id"])]: file_instance
+            for file_instance in file_resource["file_instances"]
+        }
 
-            if to_storage_name in storage_names:
-                logging.info(
-                    "skipping file resource {} that already exists on storage {}".format(
-                        file_resource["filename"], to_storage_name
-                    )
+        if to_storage["name"] in instance_storage_names:
+            logging.info(
+                "skipping file resource {} that already exists on storage {}".format(
+                    file_resource["filename"], to_storage["name"]
                 )
+            )
 
-                # Skip this file resource
-                continue
+            continue
 
-            from_file_instance = None
-
-            for file_instance in file_resource["file_instances"]:
-                # TODO(mwiens91): We're querying Tantalus for storage
-                # names above and here. Two requests for identical
-                # information. We only really need to do it once. Fix
-                # this by saving the storage name in the file_instance
-                # dictionary after the first set of API requests.
-                storage_id = file_instance["storage"]["id"]
-                storage_name = tantalus_api.get("storage", id=int(storage_id))["name"]
-
-                if storage_name == from_storage_name:
-                    from_file_instance = file_instance
-
-            if from_file_instance is None:
-                raise FileDoesNotExist(
-                    "file instance for file resource {} does not exist on source storage {}".format(
-                        file_resource["filename"], from_storage_name
-                    )
+        if from_storage["name"] not in instance_storage_names:
+            raise FileDoesNotExist(
+                "file instance for file resource {} does not exist on source storage {}".format(
+                    file_resource["filename"], from_storage["name"]
                 )
+            )
+
+        # Build a "nicer" version of the file instance with its storage
+        # and file resource nested in, as the transfer functions expect.
+        # A file that hasn't reached the relay storage yet has no
+        # instance there.
+        from_file_instance = dict(
+            instance_storage_names.get(read_storage["name"], dict(id=None)),
+            storage=read_storage,
+            file_resource=file_resource,
+        )
+
+        if "filepath" not in from_file_instance:
+            from_file_instance["filepath"] = get_new_filepath(
+                read_storage,
+                file_resource,
+                filename_override=from_file_instance.get("filename_override"),
+            )
+
+        plan.append(
+            dict(
+                file_resource=file_resource,
+                file_instance=from_file_instance,
+                filepath=get_new_filepath(to_storage, file_resource),
+                size=file_resource["size"],
+            )
+        )
+
+    return plan
+
+
+def summarize_transfer_plan(plan):
+    """Get the number of files and total bytes in a transfer plan."""
+    return dict(
+        num_files=len(plan),
+        total_bytes=sum(entry["size"] or 0 for entry in plan),
+    )
 
-            # Get a "nicer" version of the file instance with more
-            # nested model relationships
-            from_file_instance = tantalus_api.get(
-                "file_instance", id=from_file_instance["id"]
+
+def log_transfer_plan(plan, from_storage, to_storage, verbose=False):
+    """Log a summary of a transfer plan, optionally listing each file."""
+    if verbose:
+        for entry in plan:
+            logging.info(
+                "planned {} -> {} ({} bytes)".format(
+                    entry["file_instance"]["filepath"], entry["filepath"], entry["size"]
+                )
             )
 
+    summary = summarize_transfer_plan(plan)
+
+    logging.info(
+        "transfer plan from {} to {}: {} files, {} GB".format(
+            from_storage["name"],
+            to_storage["name"],
+            summary["num_files"],
+            as_gb(summary["total_bytes"]),
+        )
+    )
+
+
+SCHEDULING_POLICIES = ("plan", "largest_first", "smallest_first")
+
+
+def _get_entry_size(entry):
+    return entry["size"] or 0
+
+
+def schedule_transfer_plan(plan, policy="plan"):
+    """Order a transfer plan for concurrent workers.
+
+    Policies:
+        plan: Keep the order the plan was built in.
+        largest_first: Start the largest files first, so a large file
+            never starts at the end of a run with the other workers
+            idle. As each file goes to the next free worker, this also
+            balances the bytes each worker moves about as well as
+            packing the files into equal bins up front would.
+        smallest_first: Start the smallest files first, to register as
+            many files as early as possible.
+
+    Returns:
+        The reordered plan.
+
+    Raises:
+        ValueError: The policy isn't one of SCHEDULING_POLICIES.
+    """
+    if policy == "plan":
+        return list(plan)
+    elif policy == "largest_first":
+        return sorted(plan, key=_get_entry_size, reverse=True)
+    elif policy == "smallest_first":
+        return sorted(plan, key=_get_entry_size)
+
+    raise ValueError(
+        "unknown scheduling policy {}, expected one of {}".format(
+            policy, ", ".join(SCHEDULING_POLICIES)
+        )
+    )
+
+
+def _flatten(future):
+    """Get a Future for the result of a Future which may hold a Future."""
+    flattened = Future()
+
+    def callback(done):
+        if done.cancelled():
+            flattened.cancel()
+            return
+
+        error = done.exception()
+
+        if error is not None:
+            flattened.set_exception(error)
+        elif isinstance(done.result(), Future):
+            done.result().add_done_callback(callback)
+        else:
+            flattened.set_result(done.result())
+
+    future.add_done_callback(callback)
+
+    return flattened
+
+
+class TransferPlanExecutor(object):
+    """Runs the transfers in a plan and registers the new file instances.
+
+    A transfer function either finishes a transfer before returning or
+    returns a Future for a transfer that completes in the background.
+    Transfers which return (or resolve to) SKIPPED are registered but
+    counted as moving no bytes.
+    Transfer functions are called on num_workers worker threads, in
+    plan order, and a transfer is only handed to the workers once one
+    is free. At most max_pending transfers are outstanding at once,
+    including those still in the background. Failed
+    transfers are retried, and a file instance is only registered once
+    its transfer has completed. With a FileInstanceRegistrar, the
+    registration is queued rather than made in line. A transfer is
+    marked in flight in the journal when a worker starts it.
+
+    Without a journal the first file to fail all of its retries aborts
+    the run: transfers which haven't started are cancelled, and those
+    already running are waited for and registered before the error is
+    raised. With a journal, failures are recorded and the remaining
+    files are still transferred.
+
+    A fan-out stage reading from another destination is given that
+    destination's Relay as relay_from, and each file is only started
+    once it has landed there. A destination other stages read from is
+    given its Relay as relay_to, and each file is passed on as soon as
+    it is done.
+    """
+
+    def __init__(
+        self,
+        f_transfer,
+        to_storage,
+        tantalus_api,
+        journal=None,
+        metrics=None,
+        retries=3,
+        max_pending=64,
+        num_workers=1,
+        registrar=None,
+        relay_from=None,
+        relay_to=None,
+    ):
+        self.f_transfer = f_transfer
+        self.to_storage = to_storage
+        self.tantalus_api = tantalus_api
+        self.journal = journal
+        self.metrics = metrics
+        self.registrar = registrar
+        self.relay_from = relay_from
+        self.relay_to = relay_to
+        self.retries = retries
+        self.max_pending = max(max_pending, num_workers)
+        self.num_workers = num_workers
+        self.num_failed = 0
+
+        self._workers = ThreadPoolExecutor(max_workers=num_workers)
+
+        # Outstanding transfers, keyed by future, with their planned
+        # transfer, attempt number, start time, and the future of the
+        # call on the worker thread
+        self._pending = {}
+
+        # The error aborting the run, if any
+        self._fatal_error = None
+
+    def _start(self, entry, attempt, start_time):
+        if attempt == 0:
             logging.info(
                 "starting transfer {} to {}".format(
-                    file_resource["filename"], to_storage["name"]
+                    entry["file_resource"]["filename"], self.to_storage["name"]
+                )
+            )
+
+        worker_future = self._workers.submit(self._transfer, entry, attempt)
+        future = _flatten(worker_future)
+
+        self._pending[future] = (entry, attempt, start_time, worker_future)
+
+    def _transfer(self, entry, attempt):
+        if self.journal is not None and attempt == 0:
+            self.journal.mark_in_flight(entry)
+
+        try:
+            if self.relay_from is not None:
+                landing = self.relay_from.get_landing(entry["file_resource"]["id"])
+
+                # Raises the error the file failed to land with
+                if landing is not None:
+                    landing.result()
+
+            return self.f_transfer(entry["file_instance"], self.to_storage)
+        except Exception:
+            traceback.print_exc()
+            raise
+
+    def _finish(self, future):
+        entry, attempt, start_time, _ = self._pending.pop(future)
+
+        if future.cancelled():
+            return
+
+        error = future.exception()
+        skipped = error is None and future.result() == SKIPPED
+
+        if error is None and self.registrar is not None:
+            self.registrar.register(
+                entry["file_resource"]["id"], self.to_storage["id"]
+            )
+        elif error is None:
+            try:
+                self.tantalus_api.get_or_create(
+                    "file_instance",
+                    file_resource=entry["file_resource"]["id"],
+                    storage=self.to_storage["id"],
+                )
+            except Exception as e:
+                error = e
+
+        if error is None:
+            self._record(entry, attempt, start_time, skipped=skipped)
+
+            if skipped:
+                get_transfer_progress().file_skipped(
+                    entry["file_resource"]["id"], entry["size"] or 0
+                )
+            else:
+                get_transfer_progress().file_done(
+                    entry["file_resource"]["id"], entry["size"] or 0
+                )
+
+            if self.journal is not None:
+                self.journal.mark_done(
+                    entry, 0 if skipped else entry["size"], time.time() - start_time
                 )
+
+            if self.relay_to is not None:
+                self.relay_to.landed(entry)
+
+            return
+
+        logging.error(
+            "Transfer of {} failed: {}".format(
+                entry["file_resource"]["filename"], error
             )
+        )
+
+        if attempt < self.retries - 1 and self._fatal_error is None:
+            logging.error("Retrying.")
+            get_transfer_progress().file_retried(entry["file_resource"]["id"])
+            self._start(entry, attempt + 1, start_time)
+
+            return
 
-            RETRIES = 3
+        logging.error("Failed all retry attempts")
 
-            for retry in range(RETRIES):
-                try:
-                    f_transfer(from_file_instance, to_storage, tantalus_api)
+        self._record(entry, attempt, start_time, error=error)
+        get_transfer_progress().file_failed(entry["file_resource"]["id"])
+
+        if self.relay_to is not None:
+            self.relay_to.failed(entry, error)
+
+        if self.journal is None:
+            if self._fatal_error is None:
+                self._fatal_error = error
+
+            return
+
+        self.journal.mark_failed(entry, error, time.time() - start_time)
+        self.num_failed += 1
+
+    def _record(self, entry, attempt, start_time, error=None, skipped=False):
+        if self.metrics is None:
+            return
+
+        from_storage = entry["file_instance"]["storage"]
+
+        self.metrics.record_transfer(
+            entry["file_resource"]["filename"],
+            entry["size"] or 0,
+            time.time() - start_time,
+            attempt,
+            from_storage["name"],
+            self.to_storage["name"],
+            "{}_to_{}".format(
+                from_storage["storage_type"], self.to_storage["storage_type"]
+            ),
+            error=error,
+            skipped=skipped,
+        )
+
+    def _get_busy_workers(self):
+        return [
+            worker_future
+            for _, _, _, worker_future in self._pending.values()
+            if not worker_future.done()
+        ]
+
+    def _wait(self, max_pending, max_busy_workers=None):
+        """Finish transfers until few enough are outstanding.
+
+        Waits until at most max_pending transfers are outstanding and,
+        if max_busy_workers is given, at most that many are still on a
+        worker thread rather than in the background.
+        """
+        if max_busy_workers is None:
+            max_busy_workers = max_pending
+
+        while True:
+            done = [future for future in self._pending if future.done()]
+
+            if not done:
+                busy_workers = self._get_busy_workers()
+
+                if (
+                    len(self._pending) <= max_pending
+                    and len(busy_workers) <= max_busy_workers
+                ):
+                    return
+
+                wait(
+                    list(self._pending) + busy_workers, return_when=FIRST_COMPLETED
+                )
+
+            for future in done:
+                self._finish(future)
+
+    def _wait_for_landing(self, entry):
+        """Finish transfers until a file has landed on the relay storage."""
+        if self.relay_from is None:
+            return
+
+        landing = self.relay_from.get_landing(entry["file_resource"]["id"])
+
+        while landing is not None and not landing.done():
+            wait(list(self._pending) + [landing], return_when=FIRST_COMPLETED)
+
+            for future in [future for future in self._pending if future.done()]:
+                self._finish(future)
+
+    def _abort(self):
+        """Cancel the transfers which haven't started and finish the rest."""
+        for _, _, _, worker_future in list(self._pending.values()):
+            worker_future.cancel()
+
+        self._wait(0)
+
+    def run(self, plan):
+        """Transfer every file in a plan."""
+        summary = summarize_transfer_plan(plan)
+        get_transfer_progress().add_planned(
+            summary["num_files"], summary["total_bytes"]
+        )
+
+        try:
+            for entry in plan:
+                self._wait_for_landing(entry)
+                self._start(entry, 0, time.time())
+                self._wait(self.max_pending - 1, self.num_workers - 1)
+
+                if self._fatal_error is not None:
                     break
-                except Exception as e:
-                    logging.error("Transfer failed. Retrying.")
-
-                    if retry < RETRIES - 1:
-                        traceback.print_exc()
-                    else:
-                        logging.error("Failed all retry attempts")
-                        raise e
-
-            tantalus_api.get_or_create(
-                "file_instance",
-                file_resource=file_resource["id"],
-                storage=to_storage["id"],
+
+            self._wait(0)
+        finally:
+            self._abort()
+            self._workers.shutdown(wait=True)
+
+        if self._fatal_error is not None:
+            raise self._fatal_error
+
+        if self.num_failed:
+            raise Exception(
+                "{} of {} transfers failed, see journal {}".format(
+                    self.num_failed, len(plan), self.journal.path
+                )
+            )
+
+
+def execute_transfer_plan(
+    plan,
+    f_transfer,
+    to_storage,
+    tantalus_api,
+    journal=None,
+    metrics=None,
+    num_workers=1,
+    registrar=None,
+    relay_from=None,
+    relay_to=None,
+):
+    """Transfer every file in a plan and register the new instances."""
+    TransferPlanExecutor(
+        f_transfer,
+        to_storage,
+        tantalus_api,
+        journal=journal,
+        metrics=metrics,
+        num_workers=num_workers,
+        registrar=registrar,
+        relay_from=relay_from,
+        relay_to=relay_to,
+    ).run(plan)
+
+
+def get_journaled_transfer_plan(
+    journal,
+    tantalus_api,
+    tag_names,
+    from_storage,
+    to_storage,
+    retry_failed=False,
+    relay_storage=None,
+):
+    """Get a transfer plan, resuming from a journal if possible.
+
+    A new journal records a freshly built plan. An existing journal
+    supplies the unfinished part of its plan (or only the failed part,
+    if retry_failed is set) without any requests to Tantalus.
+    """
+    job = dict(
+        tag_names=tag_names,
+        from_storage=(relay_storage or from_storage)["name"],
+        to_storage=to_storage["name"],
+    )
+
+    if journal.get_job() is None:
+        plan = build_transfer_plan(
+            tantalus_api,
+            tag_names,
+            from_storage,
+            to_storage,
+            relay_storage=relay_storage,
+        )
+        journal.start_job(job, plan)
+
+        return plan
+
+    journal.check_job(job)
+
+    logging.info(
+        "resuming from journal {} with transfer states {}".format(
+            journal.path, journal.get_state_counts()
+        )
+    )
+
+    if retry_failed:
+        return journal.load_plan(states=(FAILED,))
+
+    return journal.load_plan()
+
+
+def check_server_destinations(to_storages):
+    """Check that every server destination is on the same host.
+
+    Files for server storages are written to local paths, so this
+    process must run on the host of every server destination.
+
+    Raises:
+        ValueError: The server destinations are on different hosts.
+    """
+    server_ips = set(
+        to_storage["server_ip"]
+        for to_storage in to_storages
+        if to_storage["storage_type"] == "server"
+    )
+
+    if len(server_ips) > 1:
+        raise ValueError(
+            "server destinations {} are on different hosts ({}), run a "
+            "separate transfer on each host".format(
+                ", ".join(
+                    to_storage["name"]
+                    for to_storage in to_storages
+                    if to_storage["storage_type"] == "server"
+                ),
+                ", ".join(sorted(server_ips)),
+            )
+        )
+
+
+def get_fan_out_stages(to_storages):
+    """Choose where each destination storage gets its files from.
+
+    The first destination of each storage type is sent files from the
+    source storage. Every other destination is sent files from the first
+    destination of its type, each file as soon as it has landed there
+    (see Relay), so all the stages run at once. This way the source is
+    read once per storage type rather than once per destination: further
+    blob destinations are server-side copies, and further server
+    destinations are local copies, which is why all server destinations
+    must be on one host (see check_server_destinations).
+
+    Returns:
+        A list of (to_storage, relay_storage) pairs, where relay_storage
+        is the destination to read the files from, or None to read them
+        from the source storage.
+    """
+    primary_storages = collections.OrderedDict()
+
+    for to_storage in to_storages:
+        primary_storages.setdefault(to_storage["storage_type"], to_storage)
+
+    stages = [(to_storage, None) for to_storage in primary_storages.values()]
+
+    for to_storage in to_storages:
+        primary_storage = primary_storages[to_storage["storage_type"]]
+
+        if to_storage is not primary_storage:
+            stages.append((to_storage, primary_storage))
+
+    return stages
+
+
+class Relay(object):
+    """Passes the files landing on a destination on to other stages.
+
+    The stage transferring to the destination says which files it plans
+    to transfer, and then whether each of them landed. Stages reading
+    from the destination wait for a file to land before sending it on.
+    Files which aren't in the plan are already on the destination.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+        self._planned = threading.Event()
+        self._landings = {}
+        self._error = None
+
+    def expect(self, plan):
+        """Expect the files in the destination's transfer plan to land."""
+        self._landings = {entry["file_resource"]["id"]: Future() for entry in plan}
+        self._planned.set()
+
+    def landed(self, entry):
+        """Pass on a planned file which has landed."""
+        landing = self._landings[entry["file_resource"]["id"]]
+
+        if not landing.done():
+            landing.set_result(None)
+
+    def failed(self, entry, error):
+        """Pass on the error a planned file failed to land with."""
+        landing = self._landings[entry["file_resource"]["id"]]
+
+        if not landing.done():
+            landing.set_exception(error)
+
+    def close(self, error=None):
+        """Stop the relay, failing any planned files yet to land.
+
+        Args:
+            error: The error the stage transferring to the destination
+                failed with, if it failed.
+        """
+        if error is None:
+            error = Exception(
+                "transfer to {} ended before the file landed".format(
+                    self.storage["name"]
+                )
             )
 
+        if not self._planned.is_set():
+            self._error = error
+            self._planned.set()
+
+        for landing in self._landings.values():
+            if not landing.done():
+                landing.set_exception(error)
+
+    def get_landing(self, file_resource_id):
+        """Get a Future for a file landing on the destination.
+
+        Waits for the destination's plan first.
+
+        Returns:
+            A Future which resolves once the file has landed, or None if
+            the file was already on the destination.
+
+        Raises:
+            The error the stage transferring to the destination failed
+            with, if it failed before planning.
+        """
+        self._planned.wait()
+
+        if self._error is not None:
+            raise self._error
+
+        return self._landings.get(file_resource_id)
+
+
+def add_storage_credentials(tantalus_api, storage):
+    """Replace a blob storage's credential ID with the credential itself."""
+    if storage["storage_type"] == "blob" and not isinstance(
+        storage["credentials"], Mapping
+    ):
+        storage["credentials"] = tantalus_api.get(
+            "storage_azure_blob_credentials", id=storage["credentials"]
+        )
+
+
+def transfer_tagged_files(
+    tantalus_api,
+    tag_names,
+    from_storage,
+    to_storage,
+    metrics,
+    dry_run=False,
+    journal_path=None,
+    retry_failed=False,
+    download_connections=8,
+    batch_rsync=False,
+    checksums=None,
+    folder_shards=4,
+    local_hardlinks=False,
+    scheduling_policy="plan",
+    num_workers=1,
+    relay_from=None,
+    relay_to=None,
+):
+    """Transfer the files with some tags from one storage to another.
+
+    If relay_from is given, the files are read from its storage as they
+    land there, rather than from from_storage. If relay_to is given, it
+    is told which files are planned and as each one lands. See
+    transfer_files for the other arguments.
+    """
+    relay_storage = None if relay_from is None else relay_from.storage
+
+    # Replay registrations a crashed run left behind before planning,
+    # so that their files aren't planned again
+    if journal_path is not None and not dry_run:
+        FileInstanceRegistrar(
+            tantalus_api, log_path=journal_path + ".registrations"
+        ).close()
+
+    if journal_path is not None and not dry_run:
+        journal = TransferJournal(journal_path)
+        plan = get_journaled_transfer_plan(
+            journal,
+            tantalus_api,
+            tag_names,
+            from_storage,
+            to_storage,
+            retry_failed=retry_failed,
+            relay_storage=relay_storage,
+        )
+    else:
+        journal = None
+        plan = build_transfer_plan(
+            tantalus_api,
+            tag_names,
+            from_storage,
+            to_storage,
+            relay_storage=relay_storage,
+        )
+
+    plan = schedule_transfer_plan(plan, policy=scheduling_policy)
+
+    # Files are read from the relay storage from here on
+    if relay_storage is not None:
+        from_storage = relay_storage
+
+    log_transfer_plan(plan, from_storage, to_storage, verbose=dry_run)
+
+    if dry_run:
+        return
+
+    if relay_to is not None:
+        relay_to.expect(plan)
+
+    add_storage_credentials(tantalus_api, to_storage)
+    add_storage_credentials(tantalus_api, from_storage)
+
+    # Look up which destination blobs already exist with a listing of
+    # each directory holding many of them, rather than a request or two
+    # per blob
+    if to_storage["storage_type"] == "blob" and plan:
+        blob_index = get_blob_index(
+            BlockBlobService(
+                account_name=to_storage["storage_account"],
+                account_key=to_storage["credentials"]["storage_key"],
+            ),
+            to_storage["storage_container"],
+            [entry["filepath"].split("/", 1)[1] for entry in plan],
+        )
+    else:
+        blob_index = None
+
+    f_transfer = get_file_transfer_function(
+        from_storage,
+        to_storage,
+        download_connections=download_connections,
+        checksums=checksums,
+        folder_shards=folder_shards,
+        blob_index=blob_index,
+        local_hardlinks=local_hardlinks,
+    )
+
+    # Relayed files may not have landed yet, so they can't be batched
+    if (
+        batch_rsync
+        and relay_from is None
+        and from_storage["storage_type"] == "server"
+        and to_storage["storage_type"] == "server"
+    ):
+        metrics.add_extra(
+            batched_rsync={
+                to_storage["name"]: rsync_files_batched(
+                    plan, to_storage, checksums=checksums
+                )
+            }
+        )
+
+    registrar = FileInstanceRegistrar(
+        tantalus_api,
+        log_path=None if journal_path is None else journal_path + ".registrations",
+    )
+
+    try:
+        execute_transfer_plan(
+            plan,
+            f_transfer,
+            to_storage,
+            tantalus_api,
+            journal=journal,
+            metrics=metrics,
+            num_workers=num_workers,
+            registrar=registrar,
+            relay_from=relay_from,
+            relay_to=relay_to,
+        )
+    finally:
+        # Flush the registrations even if the run is failing
+        registrar.close()
+
+        if journal is not None:
+            journal.close()
+
+        if hasattr(f_transfer, "copy_tracker"):
+            metrics.add_extra(
+                blob_copies={to_storage["name"]: f_transfer.copy_tracker.get_stats()}
+            )
+
+
+def run_fan_out_stage(relay_to, *args, **kwargs):
+    """Run a stage of transfer_tagged_files, closing its relay after.
+
+    Any relay_to is told whether the stage failed, so that the stages
+    reading from its destination don't wait on files that won't land.
+    """
+    try:
+        transfer_tagged_files(*args, relay_to=relay_to, **kwargs)
+    except Exception as e:
+        if relay_to is not None:
+            relay_to.close(e)
+        raise
+
+    if relay_to is not None:
+        relay_to.close()
+
+
+def transfer_files(
+    tag_name,
+    from_storage_name,
+    to_storage_name,
+    dry_run=False,
+    journal_path=None,
+    retry_failed=False,
+    download_connections=8,
+    batch_rsync=False,
+    checksums=None,
+    metrics_path=None,
+    bandwidth_limit=None,
+    bandwidth_schedule=None,
+    folder_shards=4,
+    local_hardlinks=False,
+    scheduling_policy="plan",
+    num_workers=1,
+):
+    """ Transfer a set of files
+
+    tag_name and to_storage_name may each be a single name or a list of
+    names. The files of all the tags are transferred once each, to every
+    destination storage. With several destinations, the source is only
+    read once per destination storage type, and the other destinations
+    are sent each file as it lands on the first destination of their
+    type (see get_fan_out_stages).
+
+    The tags are resolved into a transfer plan for each destination
+    before any file is transferred to it. If dry_run is set, the plans
+    (all from the source storage) are only logged.
+
+    If journal_path is given, the plan and the state of each transfer
+    are recorded in a SQLite journal at that path, and rerunning with
+    the same journal resumes from the first unfinished file. Setting
+    retry_failed reruns only the transfers that failed. With several
+    destinations, each gets its own journal at journal_path suffixed
+    with the storage name.
+
+    File instances are registered in Tantalus from a background thread
+    as transfers finish. With a journal, the registrations are also
+    logged next to it (suffixed with ".registrations"), and any a
+    crashed run didn't get to are registered when the job is rerun.
+
+    Blob downloads use download_connections concurrent ranged GETs.
+
+    If batch_rsync is set, server to server transfers first send files
+    in batches with one rsync run each, falling back to rsyncing files
+    one at a time for anything the batches didn't transfer.
+
+    checksums is an optional list of checksum algorithms (e.g. ["md5"]
+    or ["md5", "crc32"]) computed as files are transferred. The MD5 is
+    verified against the source blob's Content-MD5 or the MD5 stored in
+    Tantalus, whichever is available.
+
+    The progress of the whole run is logged every few seconds, and a
+    summary of the run's throughput is logged at the end. If
+    metrics_path is given, a JSON record for every file transferred and
+    the summary are also appended to that file.
+
+    bandwidth_limit is an optional limit in MB/s on the rate all
+    transfers in the process move data at, and bandwidth_schedule an
+    optional list of time-of-day windows with their own limits (see
+    utils.bandwidth.BandwidthBudget). rsync runs are limited with
+    --bwlimit and Azure downloads and uploads are throttled as they go.
+    Server-side blob copies don't pass through this machine and aren't
+    limited.
+
+    Folders transferred between servers are listed into a manifest of
+    files and sent in folder_shards parallel rsync runs, and then
+    checked against the manifest.
+
+    Files whose source storage is on the same server as the destination
+    are copied natively rather than with rsync. If local_hardlinks is
+    set, they are hardlinked instead when both storages share a
+    filesystem.
+
+    Up to num_workers files are transferred at once, started in the
+    order given by scheduling_policy (see schedule_transfer_plan).
+    """
+    tag_names = tag_name if isinstance(tag_name, list) else [tag_name]
+
+    if isinstance(to_storage_name, list):
+        to_storage_names = to_storage_name
+    else:
+        to_storage_names = [to_storage_name]
+
+    # Connect to the Tantalus API (this requires appropriate environment
+    # variables defined)
+    tantalus_api = TantalusApi()
+
+    # Get the storage details, sans credentials
+    from_storage = tantalus_api.get("storage", name=from_storage_name)
+    to_storages = [
+        tantalus_api.get("storage", name=name) for name in to_storage_names
+    ]
+
+    check_server_destinations(to_storages)
+
+    if dry_run:
+        stages = [(to_storage, None) for to_storage in to_storages]
+    else:
+        stages = get_fan_out_stages(to_storages)
+
+    # The destinations which other stages read from
+    relays = {
+        relay_storage["name"]: Relay(relay_storage)
+        for _, relay_storage in stages
+        if relay_storage is not None
+    }
+
+    configure_bandwidth_budget(
+        limit_mb=bandwidth_limit,
+        schedule=bandwidth_schedule,
+        max_transfers=num_workers,
+    )
+
+    metrics = TransferMetrics(metrics_path)
+
+    progress = reset_transfer_progress()
+
+    if not dry_run:
+        progress.start()
+
+    # Dry runs only log their plans, one stage after another
+    stage_executor = ThreadPoolExecutor(max_workers=1 if dry_run else len(stages))
+
+    try:
+        stage_futures = []
+
+        for to_storage, relay_storage in stages:
+            if journal_path is not None and len(to_storages) > 1:
+                stage_journal_path = journal_path + "." + to_storage["name"]
+            else:
+                stage_journal_path = journal_path
+
+            if relay_storage is None:
+                relay_from = None
+            else:
+                relay_from = relays[relay_storage["name"]]
+
+            stage_futures.append(
+                stage_executor.submit(
+                    run_fan_out_stage,
+                    relays.get(to_storage["name"]),
+                    tantalus_api,
+                    tag_names,
+                    from_storage,
+                    to_storage,
+                    metrics,
+                    relay_from=relay_from,
+                    dry_run=dry_run,
+                    journal_path=stage_journal_path,
+                    retry_failed=retry_failed,
+                    download_connections=download_connections,
+                    batch_rsync=batch_rsync,
+                    checksums=checksums,
+                    folder_shards=folder_shards,
+                    local_hardlinks=local_hardlinks,
+                    scheduling_policy=scheduling_policy,
+                    num_workers=num_workers,
+                )
+            )
+
+        wait(stage_futures)
+
+        for stage_future in stage_futures:
+            stage_future.result()
+    finally:
+        stage_executor.shutdown(wait=True)
+
+        if not dry_run:
+            progress.stop()
+            metrics.close(progress=progress.get_snapshot())
+
 
 if __name__ == "__main__":
     # Parse the incoming arguments
@@ -506,7 +2249,20 @@ if __name__ == "__main__":
 
     # Transfer some files
     transfer_files(
-        tag_name=args["tag_name"],
+        tag_name=args.get("tag_names", args.get("tag_name")),
         from_storage_name=args["from_storage"],
-        to_storage_name=args["to_storage"],
+        to_storage_name=args.get("to_storages", args.get("to_storage")),
+        dry_run=args.get("dry_run", False),
+        journal_path=args.get("journal_path"),
+        retry_failed=args.get("retry_failed", False),
+        download_connections=args.get("download_connections", 8),
+        batch_rsync=args.get("batch_rsync", False),
+        checksums=args.get("checksums"),
+        metrics_path=args.get("metrics_path"),
+        bandwidth_limit=args.get("bandwidth_limit"),
+        bandwidth_schedule=args.get("bandwidth_schedule"),
+        folder_shards=args.get("folder_shards", 4),
+        local_hardlinks=args.get("local_hardlinks", False),
+        scheduling_policy=args.get("scheduling_policy", "plan"),
+        num_workers=args.get("num_workers", 1),
     )
@@ -0,0 +1,205 @@
+"""Contains a BAM header reader which only fetches the start of a BAM.
+
+A BAM file is a series of BGZF blocks (gzip members) and its header
+comes first, so the header can be decoded from the leading bytes of the
+file alone. For blobs, those bytes are fetched with ranged GETs, growing
+the range until the whole header has arrived.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import struct
+import zlib
+
+
+BAM_MAGIC = b"BAM\x01"
+
+# The bytes fetched first, and the most fetched before giving up
+INITIAL_HEADER_READ_SIZE = 64 * 1024
+MAX_HEADER_READ_SIZE = 256 * 1024 * 1024
+
+# Header fields pysam gives as integers, by record type
+_INTEGER_FIELDS = {"SQ": ("LN",), "RG": ("PI",)}
+
+
+class BamHeaderError(Exception):
+    """An error for when a BAM header can't be read."""
+
+    pass
+
+
+def decompress_bgzf(data):
+    """Decompress as much as possible of the start of a BGZF file.
+
+    The data may end part way through a block, in which case what can
+    be decompressed of that block is included.
+    """
+    output = []
+
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        try:
+            output.append(decompressor.decompress(data))
+        except zlib.error:
+            break
+
+        # Data after the end of this block starts the next block
+        data = decompressor.unused_data
+
+    return b"".join(output)
+
+
+def parse_sam_header_text(text):
+    """Parse SAM header text into a dictionary like pysam's.
+
+    Returns:
+        A dictionary with the HD record as a dictionary, the SQ, RG, PG
+        (and any other) records as lists of dictionaries, and CO
+        comments as a list of strings.
+    """
+    header = {}
+
+    for line in text.splitlines():
+        if not line.startswith("@"):
+            continue
+
+        record_type, _, rest = line[1:].partition("\t")
+
+        if record_type == "CO":
+            header.setdefault("CO", []).append(rest)
+            continue
+
+        record = {}
+
+        for field in rest.split("\t"):
+            tag, _, value = field.partition(":")
+
+            if not tag:
+                continue
+
+            if tag in _INTEGER_FIELDS.get(record_type, ()):
+                value = int(value)
+
+            record[tag] = value
+
+        if record_type == "HD":
+            header["HD"] = record
+        else:
+            header.setdefault(record_type, []).append(record)
+
+    return header
+
+
+def parse_bam_header(data):
+    """Parse a BAM header from the start of the decompressed BAM.
+
+    Returns:
+        The header as from parse_sam_header_text, or None if more data
+        is needed. References are only read from the binary header when
+        the header text has no SQ records, as pysam does.
+
+    Raises:
+        BamHeaderError: The data isn't from a BAM file.
+    """
+    if len(data) < 8:
+        return None
+
+    if data[:4] != BAM_MAGIC:
+        raise BamHeaderError("not a BAM file")
+
+    (text_length,) = struct.unpack("<i", data[4:8])
+    offset = 8 + text_length
+
+    if len(data) < offset:
+        return None
+
+    text = data[8:offset].rstrip(b"\0").decode("utf-8", "replace")
+    header = parse_sam_header_text(text)
+
+    if "SQ" in header:
+        return header
+
+    if len(data) < offset + 4:
+        return None
+
+    (num_references,) = struct.unpack("<i", data[offset : offset + 4])
+    offset += 4
+
+    references = []
+
+    for _ in range(num_references):
+        if len(data) < offset + 4:
+            return None
+
+        (name_length,) = struct.unpack("<i", data[offset : offset + 4])
+        offset += 4
+
+        if len(data) < offset + name_length + 4:
+            return None
+
+        name = data[offset : offset + name_length - 1].decode("utf-8")
+        offset += name_length
+
+        (length,) = struct.unpack("<i", data[offset : offset + 4])
+        offset += 4
+
+        references.append(dict(SN=name, LN=length))
+
+    if references:
+        header["SQ"] = references
+
+    return header
+
+
+def read_bam_header(read_range, initial_size=INITIAL_HEADER_READ_SIZE):
+    """Read a BAM header by fetching only the start of the file.
+
+    Args:
+        read_range: A function taking an inclusive byte range (start,
+            end) and returning those bytes of the file, or fewer at the
+            end of the file.
+        initial_size: The number of bytes to fetch first. Each further
+            fetch doubles the bytes fetched so far.
+
+    Returns:
+        The header as from parse_bam_header.
+
+    Raises:
+        BamHeaderError: The file isn't a BAM, or ends (or goes past
+            MAX_HEADER_READ_SIZE) before its header does.
+    """
+    data = b""
+    read_size = initial_size
+
+    while True:
+        start = len(data)
+        chunk = read_range(start, start + read_size - 1)
+        data += chunk
+
+        header = parse_bam_header(decompress_bgzf(data))
+
+        if header is not None:
+            return header
+
+        if len(chunk) < read_size:
+            raise BamHeaderError("file ends before its header")
+
+        if len(data) >= MAX_HEADER_READ_SIZE:
+            raise BamHeaderError(
+                "header is over {} bytes".format(MAX_HEADER_READ_SIZE)
+            )
+
+        read_size = len(data)
+
+
+def get_bam_header_blob(blob_service, container_name, blob_name):
+    """Read the header of a BAM blob with ranged GETs."""
+
+    def read_range(start, end):
+        return blob_service.get_blob_to_bytes(
+            container_name, blob_name, start_range=start, end_range=end
+        ).content
+
+    return read_bam_header(read_range)
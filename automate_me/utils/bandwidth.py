@@ -0,0 +1,207 @@
+"""Contains a process-wide bandwidth budget for file transfers.
+
+All transfers in a process draw from one budget, so that the process as
+a whole moves data at a predictable rate no matter how many transfers
+are running at once. The rate can follow a time-of-day schedule, e.g.
+to leave more of the uplink to other pipelines during working hours.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import datetime
+import threading
+import time
+
+
+# The longest a throttled transfer sleeps before checking the rate
+# again, so that schedule changes take effect promptly
+MAX_THROTTLE_SLEEP = 1.0
+
+
+def _parse_time_of_day(time_of_day):
+    return datetime.datetime.strptime(time_of_day, "%H:%M").time()
+
+
+def _mb_to_bytes(limit_mb):
+    if limit_mb is None:
+        return None
+
+    return limit_mb * 1024 * 1024
+
+
+class BandwidthBudget(object):
+    """A token bucket shared by every transfer in the process.
+
+    Transfers call consume with the bytes they are about to move (or
+    have just moved), and are made to wait whenever the process is over
+    its rate.
+
+    Transfers we can't throttle ourselves, like rsync, instead reserve
+    one of max_transfers equal shares of the rate for as long as they
+    run. Reserved shares are taken out of the token bucket's rate, so
+    the reserved shares and the bucket together never go over the limit.
+    """
+
+    def __init__(self, limit_mb=None, schedule=None, max_transfers=1):
+        """Set up the budget.
+
+        Args:
+            limit_mb: The default rate limit in MB per second, or None
+                for no limit.
+            schedule: An optional list of dictionaries with "start" and
+                "end" times of day (as "HH:MM", local time) and the
+                "limit_mb" to use between them, which overrides the
+                default. A window whose end is before its start wraps
+                around midnight. A limit of None means no limit.
+            max_transfers: The number of shares the rate is split into
+                for transfers which reserve one, usually the number of
+                transfers planned to run at once.
+        """
+        self._lock = threading.Lock()
+        self._default_rate = _mb_to_bytes(limit_mb)
+        self._schedule = [
+            (
+                _parse_time_of_day(window["start"]),
+                _parse_time_of_day(window["end"]),
+                _mb_to_bytes(window.get("limit_mb")),
+            )
+            for window in schedule or []
+        ]
+        self._tokens = 0.0
+        self._last = time.time()
+        self._max_transfers = max(max_transfers, 1)
+        self._active_transfers = 0
+
+        # Notified when a reserved share is released
+        self._share_released = threading.Condition(self._lock)
+
+    def get_rate(self, now=None):
+        """Get the current rate limit in bytes per second, or None."""
+        if now is None:
+            now = datetime.datetime.now()
+
+        time_of_day = now.time()
+
+        for start, end, rate in self._schedule:
+            if start <= end:
+                in_window = start <= time_of_day < end
+            else:
+                in_window = time_of_day >= start or time_of_day < end
+
+            if in_window:
+                return rate
+
+        return self._default_rate
+
+    def consume(self, num_bytes):
+        """Wait until the budget allows some bytes to be moved.
+
+        Bytes are taken as soon as the bucket isn't in debt, so a large
+        chunk goes through at once and the transfers that follow it wait
+        off the debt. The bucket holds at most a second's worth of
+        bytes.
+        """
+        while True:
+            with self._lock:
+                rate = self.get_rate()
+                now = time.time()
+                elapsed = now - self._last
+                self._last = now
+
+                if rate is None:
+                    self._tokens = 0.0
+                    return
+
+                # The rate left once reserved shares are taken out
+                rate -= rate * self._active_transfers / self._max_transfers
+
+                if rate <= 0:
+                    wait = MAX_THROTTLE_SLEEP
+                else:
+                    self._tokens = min(rate, self._tokens + elapsed * rate)
+
+                    if self._tokens >= 0:
+                        self._tokens -= num_bytes
+                        return
+
+                    wait = -self._tokens / rate
+
+            time.sleep(min(wait, MAX_THROTTLE_SLEEP))
+
+    def throttle_progress(self, progress_callback=None):
+        """Wrap an SDK progress callback so that it consumes bytes.
+
+        Returns:
+            A progress callback which consumes the bytes moved since its
+            last call before calling progress_callback, if given.
+        """
+        last = [0]
+
+        def callback(current, total):
+            self.consume(max(current - last[0], 0))
+            last[0] = current
+
+            if progress_callback is not None:
+                progress_callback(current, total)
+
+        return callback
+
+    def start_transfer(self):
+        """Reserve a share of the budget for a transfer.
+
+        While the rate is limited, this waits until fewer than
+        max_transfers shares are reserved, so that the shares never add
+        up to more than the limit.
+        """
+        with self._lock:
+            while (
+                self._active_transfers >= self._max_transfers
+                and self.get_rate() is not None
+            ):
+                self._share_released.wait(MAX_THROTTLE_SLEEP)
+
+            self._active_transfers += 1
+
+    def finish_transfer(self):
+        """Release a share reserved with start_transfer."""
+        with self._lock:
+            self._active_transfers -= 1
+            self._share_released.notify()
+
+    def get_share_kbps(self, num_parts=1):
+        """Get a part of one reserved share of the rate in KiB/s.
+
+        This is for processes we can't throttle ourselves, like rsync's
+        --bwlimit. A share is the rate divided by max_transfers, and a
+        transfer which runs several processes at once splits its share
+        into num_parts. Returns None if there is no limit.
+        """
+        rate = self.get_rate()
+
+        if rate is None:
+            return None
+
+        return max(int(rate / self._max_transfers / num_parts / 1024), 1)
+
+
+_budget = BandwidthBudget()
+
+
+def get_bandwidth_budget():
+    """Get the process-wide bandwidth budget."""
+    return _budget
+
+
+def configure_bandwidth_budget(limit_mb=None, schedule=None, max_transfers=1):
+    """Replace the process-wide bandwidth budget.
+
+    See BandwidthBudget for the arguments.
+    """
+    global _budget
+
+    _budget = BandwidthBudget(
+        limit_mb=limit_mb, schedule=schedule, max_transfers=max_transfers
+    )
+
+    return _budget
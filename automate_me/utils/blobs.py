@@ -0,0 +1,610 @@
+"""Contains helpers for moving data in and out of Azure blob storage."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import collections
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from azure.common import AzureMissingResourceHttpError
+from azure.storage.blob import BlobPrefix, BlockBlobService, Include
+from utils.bandwidth import get_bandwidth_budget
+
+
+# Bounds on the size of each ranged GET when downloading a blob. Every
+# connection holds one chunk in memory at a time.
+MIN_DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_DOWNLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+
+# How long a waiting range sleeps before checking again whether the
+# download has failed
+CHECKSUM_WAIT_INTERVAL = 1
+
+# How many chunks each connection should get through for a blob, so
+# that one slow range doesn't leave the other connections idle
+CHUNKS_PER_CONNECTION = 8
+
+# Files smaller than this are uploaded with a single put
+UPLOAD_SINGLE_PUT_SIZE = 32 * 1024 * 1024
+
+# Bounds on the block size used for block uploads. Azure allows at most
+# 50,000 blocks in a blob.
+MIN_UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+MAX_UPLOAD_BLOCK_SIZE = 100 * 1024 * 1024
+MAX_BLOCKS_PER_BLOB = 50000
+
+MAX_UPLOAD_CONNECTIONS = 16
+
+# Blob names a directory must hold for get_blob_index to list it rather
+# than leave its blobs to be requested one by one
+INDEX_LIST_THRESHOLD = 16
+
+# The shared BlockBlobService for the account in the environment, and
+# the process it was created in
+_block_blob_service = None
+_block_blob_service_pid = None
+
+# Throughput in bytes per second assumed for a single connection until
+# an upload has been timed
+DEFAULT_CONNECTION_THROUGHPUT = 2 * 1024 * 1024
+
+# Each request gets this many times as long as it should take at the
+# per-connection throughput, but never less than the minimum
+UPLOAD_TIMEOUT_FACTOR = 4
+MIN_UPLOAD_TIMEOUT = 60
+
+
+def _round_up_to_mib(num_bytes):
+    mib = 1024 * 1024
+    return -(-num_bytes // mib) * mib
+
+
+def get_download_chunk_size(blob_size, max_connections):
+    """Choose a ranged GET size for a blob.
+
+    Args:
+        blob_size: The size of the blob in bytes.
+        max_connections: The number of concurrent connections the blob
+            is going to be downloaded with.
+
+    Returns:
+        The chunk size in bytes, a multiple of 1 MiB.
+    """
+    chunk_size = blob_size // (max_connections * CHUNKS_PER_CONNECTION)
+    chunk_size = min(max(chunk_size, MIN_DOWNLOAD_CHUNK_SIZE), MAX_DOWNLOAD_CHUNK_SIZE)
+
+    return _round_up_to_mib(chunk_size)
+
+
+def get_upload_parameters(size, connection_throughput=None):
+    """Choose how to upload a file of some size.
+
+    Args:
+        size: The size of the file in bytes.
+        connection_throughput: An optional observed throughput in bytes
+            per second for a single upload connection.
+
+    Returns:
+        A dictionary containing whether to upload with a single put
+        ("single_put"), the block size for block uploads ("block_size",
+        None for a single put), the number of connections
+        ("max_connections"), and the timeout in seconds for each request
+        ("timeout").
+    """
+    if connection_throughput is None:
+        connection_throughput = DEFAULT_CONNECTION_THROUGHPUT
+
+    if size < UPLOAD_SINGLE_PUT_SIZE:
+        request_size = size
+        block_size = None
+        max_connections = 1
+    else:
+        # Give each connection several blocks, without going over the
+        # block limit for the blob
+        block_size = size // (MAX_UPLOAD_CONNECTIONS * CHUNKS_PER_CONNECTION)
+        block_size = max(block_size, -(-size // MAX_BLOCKS_PER_BLOB))
+        block_size = _round_up_to_mib(
+            min(max(block_size, MIN_UPLOAD_BLOCK_SIZE), MAX_UPLOAD_BLOCK_SIZE)
+        )
+
+        request_size = block_size
+        max_connections = min(MAX_UPLOAD_CONNECTIONS, -(-size // block_size))
+
+    timeout = max(
+        MIN_UPLOAD_TIMEOUT,
+        int(UPLOAD_TIMEOUT_FACTOR * request_size / connection_throughput),
+    )
+
+    return dict(
+        single_put=block_size is None,
+        block_size=block_size,
+        max_connections=max_connections,
+        timeout=timeout,
+    )
+
+
+def get_byte_ranges(size, chunk_size):
+    """Split a size into inclusive (start, end) byte ranges."""
+    return [
+        (start, min(start + chunk_size, size) - 1)
+        for start in range(0, size, chunk_size)
+    ]
+
+
+def download_blob_ranges(
+    block_blob_service,
+    container_name,
+    blob_name,
+    blob_size,
+    filepath,
+    max_connections=8,
+    chunk_size=None,
+    progress_callback=None,
+    checksum=None,
+):
+    """Download a blob with concurrent ranged GETs.
+
+    The file is preallocated to the size of the blob and each range is
+    written at its offset as it arrives, so ranges can complete in any
+    order.
+
+    Args:
+        block_blob_service: A BlockBlobService for the blob's account.
+        container_name: The name of the blob's container.
+        blob_name: The name of the blob.
+        blob_size: The size of the blob in bytes.
+        filepath: The local path to download to. This is overwritten.
+        max_connections: The number of ranges to download at once.
+        chunk_size: An optional size in bytes for each range. Defaults
+            to a size chosen from the blob size.
+        progress_callback: An optional function called with the bytes
+            downloaded so far and the total bytes.
+        checksum: An optional StreamingChecksum which is handed each
+            range as it is written. Ranges don't start more than
+            max_connections ranges ahead of what has been checksummed,
+            so a stalled range can't leave the ranges after it piling
+            up in memory.
+
+    Raises:
+        IOError: A range came back with the wrong number of bytes.
+    """
+    if chunk_size is None:
+        chunk_size = get_download_chunk_size(blob_size, max_connections)
+
+    # Preallocate the file
+    with open(filepath, "wb") as f:
+        f.truncate(blob_size)
+
+    lock = threading.Lock()
+    bytes_done = [0]
+    failed = threading.Event()
+
+    # How far ahead of the checksummed data a range may start
+    checksum_window = max_connections * chunk_size
+
+    def download_range(byte_range):
+        try:
+            _download_range(byte_range)
+        except Exception:
+            failed.set()
+            raise
+
+    def _download_range(byte_range):
+        start, end = byte_range
+
+        if checksum is not None:
+            while not checksum.wait_for_offset(
+                start - checksum_window, CHECKSUM_WAIT_INTERVAL
+            ):
+                if failed.is_set():
+                    raise IOError(
+                        "download of {}/{} failed".format(container_name, blob_name)
+                    )
+
+        get_bandwidth_budget().consume(end - start + 1)
+
+        data = block_blob_service.get_blob_to_bytes(
+            container_name, blob_name, start_range=start, end_range=end
+        ).content
+        num_bytes = len(data)
+
+        if num_bytes != end - start + 1:
+            raise IOError(
+                "expected {} bytes from range {}-{} of {}/{}, got {}".format(
+                    end - start + 1, start, end, container_name, blob_name, num_bytes
+                )
+            )
+
+        with open(filepath, "r+b") as f:
+            f.seek(start)
+            f.write(data)
+
+        if checksum is not None:
+            checksum.update(start, data)
+
+        with lock:
+            bytes_done[0] += num_bytes
+
+            if progress_callback is not None:
+                progress_callback(bytes_done[0], blob_size)
+
+    executor = ThreadPoolExecutor(max_workers=max_connections)
+
+    try:
+        # Consuming the results raises the first failure, if any
+        for _ in executor.map(download_range, get_byte_ranges(blob_size, chunk_size)):
+            pass
+    finally:
+        executor.shutdown(wait=True)
+
+    if os.path.getsize(filepath) != blob_size:
+        raise IOError(
+            "downloaded {} is not the expected {} bytes".format(filepath, blob_size)
+        )
+
+
+class BlobCopyError(Exception):
+    """An error for when a server-side blob copy fails or is aborted."""
+
+    pass
+
+
+class BlobCopyTracker(object):
+    """Tracks server-side copies into a container until they finish.
+
+    A single background thread polls every pending copy, so waiting on
+    many copies costs one sweep per poll interval. Once enough copies
+    are pending in a single directory, a sweep is a single paged listing
+    of that directory rather than a request per blob. Copies which
+    haven't finished by their deadline fail.
+    """
+
+    # Pending copies above which a sweep lists blobs rather than
+    # requesting each blob's properties
+    LIST_THRESHOLD = 16
+
+    def __init__(
+        self, block_blob_service, container_name, poll_interval=5, timeout=6 * 3600
+    ):
+        """Start tracking copies into a container.
+
+        Args:
+            block_blob_service: A BlockBlobService for the destination
+                account.
+            container_name: The name of the destination container.
+            poll_interval: The seconds to wait between sweeps.
+            timeout: The seconds a copy has to finish before it fails,
+                e.g. because its destination blob was deleted.
+        """
+        self.block_blob_service = block_blob_service
+        self.container_name = container_name
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._poller = None
+
+        # Pending copies, keyed by blob name, with their future, size and
+        # deadline
+        self._pending = {}
+
+        self._start = None
+        self._num_copied = 0
+        self._bytes_copied = 0
+
+    def track(self, blob_name, copy_properties, size):
+        """Track a copy started by copy_blob.
+
+        Args:
+            blob_name: The name of the destination blob.
+            copy_properties: The CopyProperties returned by copy_blob.
+            size: The size of the blob in bytes.
+
+        Returns:
+            A Future which resolves when the copy succeeds, or raises a
+            BlobCopyError if it fails or is aborted.
+        """
+        future = Future()
+
+        with self._lock:
+            if self._start is None:
+                self._start = time.time()
+
+            self._pending[blob_name] = (future, size, time.time() + self.timeout)
+
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll)
+                self._poller.daemon = True
+                self._poller.start()
+
+        self._update(blob_name, copy_properties)
+
+        return future
+
+    def _update(self, blob_name, copy_properties):
+        """Resolve a pending copy if it has finished."""
+        if copy_properties is None or copy_properties.status == "pending":
+            return
+
+        with self._lock:
+            # The copy may have been resolved by the poller already
+            if blob_name not in self._pending:
+                return
+
+            future, size, _ = self._pending.pop(blob_name)
+
+            if copy_properties.status == "success":
+                self._num_copied += 1
+                self._bytes_copied += size
+
+        if copy_properties.status == "success":
+            future.set_result(None)
+        else:
+            future.set_exception(
+                BlobCopyError(
+                    "copy to {}/{} {}: {}".format(
+                        self.container_name,
+                        blob_name,
+                        copy_properties.status,
+                        copy_properties.status_description,
+                    )
+                )
+            )
+
+    def _get_copy_properties(self, blob_names):
+        """Get the current copy properties of some blobs by name.
+
+        Blobs whose properties can't be got are left out.
+        """
+        directories = set(
+            blob_name[: blob_name.rfind("/") + 1] for blob_name in blob_names
+        )
+
+        # Only list a single directory, never a whole container or a
+        # prefix covering many directories
+        if len(blob_names) > self.LIST_THRESHOLD and len(directories) == 1:
+            prefix = directories.pop()
+
+            if prefix:
+                blob_names = set(blob_names)
+
+                return {
+                    blob.name: blob.properties.copy
+                    for blob in self.block_blob_service.list_blobs(
+                        self.container_name, prefix=prefix, include=Include(copy=True)
+                    )
+                    if blob.name in blob_names
+                }
+
+        copy_properties = {}
+
+        for blob_name in blob_names:
+            try:
+                properties = self.block_blob_service.get_blob_properties(
+                    self.container_name, blob_name
+                ).properties
+            except Exception:
+                logging.exception(
+                    "failed to get copy status of {}/{}".format(
+                        self.container_name, blob_name
+                    )
+                )
+                continue
+
+            copy_properties[blob_name] = properties.copy
+
+        return copy_properties
+
+    def _fail_expired(self):
+        """Fail the pending copies which are past their deadline."""
+        now = time.time()
+
+        with self._lock:
+            expired = [
+                (blob_name, self._pending.pop(blob_name)[0])
+                for blob_name, (_, _, deadline) in list(self._pending.items())
+                if deadline < now
+            ]
+
+        for blob_name, future in expired:
+            future.set_exception(
+                BlobCopyError(
+                    "copy to {}/{} didn't finish within {} seconds".format(
+                        self.container_name, blob_name, self.timeout
+                    )
+                )
+            )
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+
+            with self._lock:
+                blob_names = list(self._pending)
+
+                if not blob_names:
+                    self._poller = None
+                    return
+
+            try:
+                copy_properties = self._get_copy_properties(blob_names)
+            except Exception:
+                logging.exception("failed to poll blob copy status")
+                copy_properties = {}
+
+            for blob_name, properties in copy_properties.items():
+                self._update(blob_name, properties)
+
+            self._fail_expired()
+
+            stats = self.get_stats()
+            logging.info(
+                "{} blob copies pending, {} completed at {:.2f} MB/s".format(
+                    stats["pending_copies"],
+                    stats["completed_copies"],
+                    stats["throughput"] / (1024.0 * 1024.0),
+                )
+            )
+
+    def get_stats(self):
+        """Get the pending copy count, completed copies and throughput.
+
+        Returns:
+            A dictionary containing the number of pending copies
+            ("pending_copies"), the number of completed copies
+            ("completed_copies"), the bytes copied ("bytes_copied"), and
+            the bytes per second copied since the first copy started
+            ("throughput").
+        """
+        with self._lock:
+            elapsed = 0 if self._start is None else time.time() - self._start
+
+            return dict(
+                pending_copies=len(self._pending),
+                completed_copies=self._num_copied,
+                bytes_copied=self._bytes_copied,
+                throughput=self._bytes_copied / elapsed if elapsed else 0.0,
+            )
+
+
+class BlobIndex(object):
+    """An in-memory index of the properties of some blobs in a container.
+
+    The index may cover whole directories of the container, in which case
+    blobs in those directories that aren't in the index are known not to
+    exist. The index is a snapshot: blobs written after it was built
+    aren't in it.
+    """
+
+    def __init__(self, container_name, properties=None, directories=()):
+        """Create an index from already listed blob properties.
+
+        Args:
+            container_name: The name of the container.
+            properties: A dictionary of BlobProperties by blob name.
+            directories: Directories ("a/b/") of the container whose
+                blobs are all in properties.
+        """
+        self.container_name = container_name
+        self.directories = frozenset(directories)
+        self._properties = dict(properties or {})
+
+    def covers(self, blob_name):
+        """Whether the index knows if a blob exists."""
+        return (
+            blob_name in self._properties
+            or _get_directory(blob_name) in self.directories
+        )
+
+    def get_properties(self, blob_name):
+        """Get an indexed blob's BlobProperties, or None if it is absent."""
+        return self._properties.get(blob_name)
+
+    def subset(self, blob_names):
+        """Get an index of just some of the indexed blobs.
+
+        Useful for sending the properties of a few blobs to another
+        process without sending the whole index.
+        """
+        return BlobIndex(
+            self.container_name,
+            {
+                blob_name: self._properties[blob_name]
+                for blob_name in blob_names
+                if blob_name in self._properties
+            },
+        )
+
+
+def _get_directory(blob_name):
+    """Get the directory of a blob name, e.g. "a/b/" for "a/b/c"."""
+    return blob_name[: blob_name.rfind("/") + 1]
+
+
+def get_blob_index(block_blob_service, container_name, blob_names):
+    """Index the blobs in a container that some blob names are in.
+
+    Each directory holding at least INDEX_LIST_THRESHOLD of the blob
+    names is listed once, without its subdirectories. The blobs in other
+    directories, including the root of the container, aren't indexed,
+    and are looked up one by one with get_blob_properties.
+
+    Returns:
+        A BlobIndex.
+    """
+    directory_counts = collections.Counter(
+        _get_directory(blob_name) for blob_name in blob_names
+    )
+
+    directories = [
+        directory
+        for directory, count in directory_counts.items()
+        if directory and count >= INDEX_LIST_THRESHOLD
+    ]
+
+    properties = {}
+
+    for directory in directories:
+        for blob in block_blob_service.list_blobs(
+            container_name,
+            prefix=directory,
+            delimiter="/",
+            include=Include(copy=True),
+        ):
+            # Subdirectories are listed as prefixes, which have no
+            # properties
+            if isinstance(blob, BlobPrefix):
+                continue
+
+            properties[blob.name] = blob.properties
+
+    logging.info(
+        "indexed {} blobs in {} directories of {}".format(
+            len(properties), len(directories), container_name
+        )
+    )
+
+    return BlobIndex(container_name, properties, directories)
+
+
+def get_blob_properties(
+    block_blob_service, container_name, blob_name, blob_index=None
+):
+    """Get a blob's BlobProperties, or None if the blob doesn't exist.
+
+    Blobs covered by the blob index, if one is given, are looked up in
+    it rather than requested.
+    """
+    if blob_index is not None and blob_index.covers(blob_name):
+        return blob_index.get_properties(blob_name)
+
+    try:
+        blob = block_blob_service.get_blob_properties(container_name, blob_name)
+    except AzureMissingResourceHttpError:
+        return None
+
+    return blob.properties
+
+
+def get_block_blob_service():
+    """Get the shared BlockBlobService for the environment's account.
+
+    The account comes from the AZURE_STORAGE_ACCOUNT and
+    AZURE_STORAGE_KEY environment variables. Each process gets its own
+    service, so that worker processes don't share the parent's pooled
+    connections.
+    """
+    global _block_blob_service
+    global _block_blob_service_pid
+
+    if _block_blob_service is None or _block_blob_service_pid != os.getpid():
+        _block_blob_service = BlockBlobService(
+            account_name=os.environ["AZURE_STORAGE_ACCOUNT"],
+            account_key=os.environ["AZURE_STORAGE_KEY"],
+        )
+        _block_blob_service_pid = os.getpid()
+
+    return _block_blob_service
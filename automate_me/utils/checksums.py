@@ -0,0 +1,202 @@
+"""Contains helpers for checksumming data as it is transferred.
+
+Checksums are computed on a shared thread pool, off the threads moving
+the data. hashlib releases the GIL while hashing large buffers, so this
+runs alongside the transfer itself.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import hashlib
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+# The number of threads shared by all checksum calculations
+HASH_WORKERS = 4
+
+# The size of reads when checksumming a file from disk
+HASH_READ_SIZE = 8 * 1024 * 1024
+
+_hash_executor = None
+_hash_executor_lock = threading.Lock()
+
+
+def get_hash_executor():
+    """Get the thread pool shared by all checksum calculations."""
+    global _hash_executor
+
+    with _hash_executor_lock:
+        if _hash_executor is None:
+            _hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+
+        return _hash_executor
+
+
+class _Crc32(object):
+    """A CRC-32 with the same interface as the hashlib hashes.
+
+    Much cheaper than MD5, for when only a fast consistency check is
+    needed.
+    """
+
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data):
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self):
+        return "{:08x}".format(self._value & 0xFFFFFFFF)
+
+
+def new_checksum(algorithm):
+    """Get a new checksum object for an algorithm name.
+
+    Supports "crc32" and anything hashlib supports (e.g. "md5").
+    """
+    if algorithm == "crc32":
+        return _Crc32()
+
+    return hashlib.new(algorithm)
+
+
+class StreamingChecksum(object):
+    """Checksums data handed over in chunks as it is transferred.
+
+    Chunks are given with their offsets and may arrive in any order.
+    Each chunk is hashed on the shared thread pool as soon as everything
+    before it has been hashed. Chunks ahead of a missing one are held
+    in memory, so producers should use wait_for_offset to limit how far
+    ahead they run.
+    """
+
+    def __init__(self, algorithms=("md5",)):
+        self._checksums = {
+            algorithm: new_checksum(algorithm) for algorithm in algorithms
+        }
+
+        # Guards the chunks waiting to be hashed and the next offset, and
+        # is notified when the next offset moves
+        self._lock = threading.Lock()
+        self._offset_changed = threading.Condition(self._lock)
+
+        # Held while hashing, so that chunks are hashed in order
+        self._hash_lock = threading.Lock()
+
+        self._chunks = {}
+        self._next_offset = 0
+        self._futures = []
+
+    def update(self, offset, data):
+        """Hand over a chunk of data starting at some offset."""
+        with self._lock:
+            # Ignore empty chunks and data that was read more than once
+            if not data or offset < self._next_offset:
+                return
+
+            self._chunks[offset] = data
+            self._futures.append(get_hash_executor().submit(self._hash_chunks))
+
+    def _hash_chunks(self):
+        with self._hash_lock:
+            while True:
+                with self._lock:
+                    data = self._chunks.pop(self._next_offset, None)
+
+                    if data is None:
+                        return
+
+                    self._next_offset += len(data)
+                    self._offset_changed.notify_all()
+
+                for checksum in self._checksums.values():
+                    checksum.update(data)
+
+    def wait_for_offset(self, offset, timeout=None):
+        """Wait until everything before an offset has been taken to hash.
+
+        Returns:
+            Whether the offset was reached before the timeout.
+        """
+        with self._lock:
+            if self._next_offset < offset:
+                self._offset_changed.wait(timeout)
+
+            return self._next_offset >= offset
+
+    def hexdigests(self):
+        """Wait for all chunks to be hashed and get the hex digests.
+
+        Returns:
+            A dictionary mapping algorithm names to hex digests.
+
+        Raises:
+            ValueError: Some data is missing from the chunks handed over.
+        """
+        with self._lock:
+            futures = list(self._futures)
+
+        for future in futures:
+            future.result()
+
+        if self._chunks:
+            raise ValueError(
+                "no data at offset {} to checksum".format(self._next_offset)
+            )
+
+        return {
+            algorithm: checksum.hexdigest()
+            for algorithm, checksum in self._checksums.items()
+        }
+
+
+class ChecksumReader(object):
+    """A file wrapper which checksums the data read through it.
+
+    Reads are checksummed by their offset, so readers which seek around
+    the file are supported.
+    """
+
+    def __init__(self, f, checksum):
+        self._file = f
+        self.checksum = checksum
+
+    def read(self, size=-1):
+        offset = self._file.tell()
+        data = self._file.read(size)
+        self.checksum.update(offset, data)
+        return data
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def seekable(self):
+        return True
+
+
+def _hash_file(filepath, algorithms):
+    checksums = {algorithm: new_checksum(algorithm) for algorithm in algorithms}
+
+    with open(filepath, "rb") as f:
+        for data in iter(lambda: f.read(HASH_READ_SIZE), b""):
+            for checksum in checksums.values():
+                checksum.update(data)
+
+    return {
+        algorithm: checksum.hexdigest() for algorithm, checksum in checksums.items()
+    }
+
+
+def checksum_file(filepath, algorithms=("md5",)):
+    """Checksum a file on the shared thread pool.
+
+    Returns:
+        A Future for a dictionary mapping algorithm names to hex digests.
+    """
+    return get_hash_executor().submit(_hash_file, filepath, algorithms)
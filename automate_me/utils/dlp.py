@@ -2,9 +2,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import collections
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from utils.utils import get_lanes_str
 
 
+# The most model dictionaries posted in one sequence_dataset_add request
+BULK_CHUNK_SIZE = 1000
+
+
 def fastq_paired_end_check(file_info):
     """ Check for paired ends for a set of fastq files """
 
@@ -38,17 +45,65 @@ def fastq_paired_end_check(file_info):
                 )
 
 
-def create_sequence_dataset_models(
-    file_info, storage_name, tag_name, tantalus_api, analysis_id=None
-):
-    """Create tantalus sequence models for a list of files."""
-    # Get storage and tag PKs
-    storage_pk = tantalus_api.get("storage", name=storage_name)["id"]
+class SingleFlight(object):
+    """Runs a function once per key, however many threads ask for it.
 
-    if tag_name is not None:
-        tag_pk = tantalus_api.get("sequence_dataset_tag", name=tag_name)["id"]
+    The first thread to ask for a key runs the function, and any others
+    asking while it runs wait for its result. Results are kept, so
+    later requests for the key get the same result. Failures aren't
+    kept, and the next request for the key tries again.
+    """
 
-    # Sort files by dataset
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def do(self, key, function):
+        """Get the result of a function for a key, running it at most once.
+
+        Args:
+            key: A hashable key for the call.
+            function: A function taking no arguments.
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            is_owner = future is None
+
+            if is_owner:
+                future = Future()
+                self._futures[key] = future
+
+        if is_owner:
+            try:
+                future.set_result(function())
+            except Exception as e:
+                with self._lock:
+                    del self._futures[key]
+
+                future.set_exception(e)
+                raise
+
+        return future.result()
+
+
+def get_pks_by_field(tantalus_api, table_name, field_name, values):
+    """Get the primary keys of models by the value of a unique field.
+
+    Each distinct value is looked up once, however often it is repeated.
+
+    Returns:
+        A dictionary of primary keys by field value.
+    """
+    pks = {}
+
+    for value in set(values):
+        pks[value] = tantalus_api.get(table_name, **{field_name: value})["id"]
+
+    return pks
+
+
+def group_files_by_dataset(file_info):
+    """Group file info by the name of the dataset each file belongs to."""
     dataset_info = collections.defaultdict(list)
     for info in file_info:
         dataset_name = "{}-{}-{}-{} (lanes {})".format(
@@ -60,104 +115,348 @@ def create_sequence_dataset_models(
         )
         dataset_info[dataset_name].append(info)
 
-    # Create datasets
-    for dataset_name, infos in dataset_info.iteritems():
-        # Get library PK
-        library_id = infos[0]["library_id"]
-        library_pk = tantalus_api.get("dna_library", library_id=library_id)["id"]
-
-        # Get sample PK
-        sample_id = infos[0]["sample_id"]
-        sample_pk = tantalus_api.get("sample", sample_id=sample_id)["id"]
-
-        # Build up sequence dataset attrs; we'll add to this as we
-        # proceed throughout the function
-        sequence_dataset = dict(
-            name=dataset_name,
-            dataset_type=infos[0]["dataset_type"],
-            sample=sample_pk,
-            library=library_pk,
-            sequence_lanes=[],
-            file_resources=[],
+    return dataset_info
+
+
+def check_dataset_file_info(infos):
+    """Check that the files of a dataset agree on the dataset's fields."""
+    check_fields = (
+        "dataset_type",
+        "sample_id",
+        "library_id",
+        "library_type",
+        "index_format",
+    )
+
+    for info in infos:
+        for field_name in check_fields:
+            if info[field_name] != infos[0][field_name]:
+                raise Exception("error with field {}".format(field_name))
+
+
+def get_reference_genome(ref_genome):
+    """Get the name Tantalus uses for a reference genome."""
+    # Stick with one naming scheme
+    if ref_genome.lower() == "grch36":
+        return "HG18"
+    elif ref_genome.lower() == "grch37":
+        return "HG19"
+
+    return ref_genome
+
+
+def get_sequence_dataset_model_dictionaries(
+    dataset_name, infos, storage_name, analysis_id=None
+):
+    """Get the model dictionaries for one dataset's sequence_dataset_add.
+
+    Returns:
+        A list of a FileInstance dictionary per file, followed by the
+        SequenceDataset dictionary, which refers to its sample, library,
+        lanes and files by their fields.
+    """
+    check_dataset_file_info(infos)
+
+    sample = dict(sample_id=infos[0]["sample_id"])
+    library = dict(
+        library_id=infos[0]["library_id"],
+        library_type=infos[0]["library_type"],
+        index_format=infos[0]["index_format"],
+    )
+
+    json_list = []
+
+    # Unique lanes keyed by flowcell id, lane number
+    sequence_lanes = collections.OrderedDict()
+    file_resources = []
+
+    for info in infos:
+        for sequence_lane in info["sequence_lanes"]:
+            sequence_lane = dict(sequence_lane)
+            sequence_lane["dna_library"] = library
+            sequence_lane["lane_number"] = str(sequence_lane["lane_number"])
+
+            lane_key = (sequence_lane["flowcell_id"], sequence_lane["lane_number"])
+            sequence_lanes.setdefault(lane_key, sequence_lane)
+
+        sequence_file_info = dict(index_sequence=info["index_sequence"])
+
+        if "read_end" in info:
+            sequence_file_info["read_end"] = info["read_end"]
+
+        file_resource = dict(
+            size=info["size"],
+            created=info["created"],
+            file_type=info["file_type"],
+            compression=info["compression"],
+            filename=info["filename"],
+            sequencefileinfo=sequence_file_info,
         )
+        file_resources.append(file_resource)
 
-        # Add in the analysis id if it's provided
-        if analysis_id is not None:
-            sequence_dataset["analysis"] = analysis_id
-
-        # Unique set of lanes keyed by flowcell id, lane number
-        # TODO(mwiens91): What's this for? It's not used anywhere
-        # :thinking:
-        unique_sequence_lanes = {}
-
-        # Add in BAM specific items
-        if infos[0]["dataset_type"] == "BAM":
-            sequence_dataset["aligner"] = infos[0]["aligner_name"]
-            ref_genome = infos[0]["ref_genome"]
-
-            # Stick with one naming scheme
-            if ref_genome.lower() == "grch36":
-                ref_genome = "HG18"
-            elif ref_genome.lower() == "grch37":
-                ref_genome = "HG19"
-
-            sequence_dataset["reference_genome"] = ref_genome
-
-        # Add in the tag if we have one
-        if tag_name is not None:
-            sequence_dataset["tags"] = [tag_pk]
-
-        for info in infos:
-            # Check consistency for fields used for dataset
-            check_fields = (
-                "dataset_type",
-                "sample_id",
-                "library_id",
-                "library_type",
-                "index_format",
-            )
-            for field_name in check_fields:
-                if info[field_name] != infos[0][field_name]:
-                    raise Exception("error with field {}".format(field_name))
+        file_instance = dict(
+            storage={"name": storage_name},
+            file_resource=file_resource,
+            model="FileInstance",
+        )
 
-            for sequence_lane in info["sequence_lanes"]:
-                sequence_lane = dict(sequence_lane)
-                sequence_lane["dna_library"] = library_pk
-                sequence_lane["lane_number"] = str(sequence_lane["lane_number"])
+        if "filename_override" in info:
+            file_instance["filename_override"] = info["filename_override"]
 
-                sequence_lane = tantalus_api.get_or_create(
-                    "sequencing_lane", **sequence_lane
-                )
+        json_list.append(file_instance)
+
+    sequence_dataset = dict(
+        name=dataset_name,
+        dataset_type=infos[0]["dataset_type"],
+        sample=sample,
+        library=library,
+        sequence_lanes=list(sequence_lanes.values()),
+        file_resources=file_resources,
+        model="SequenceDataset",
+    )
 
-                sequence_dataset["sequence_lanes"].append(sequence_lane["id"])
+    if analysis_id is not None:
+        sequence_dataset["analysis"] = analysis_id
 
-            sequence_file_info = dict(index_sequence=info["index_sequence"])
+    if infos[0]["dataset_type"] == "BAM":
+        sequence_dataset["aligner"] = infos[0]["aligner_name"]
+        sequence_dataset["reference_genome"] = get_reference_genome(
+            infos[0]["ref_genome"]
+        )
 
-            if "read_end" in info:
-                sequence_file_info["read_end"] = info["read_end"]
+    json_list.append(sequence_dataset)
 
-            file_resource = tantalus_api.get_or_create(
-                "file_resource",
-                size=info["size"],
-                created=info["created"],
-                file_type=info["file_type"],
-                compression=info["compression"],
-                filename=info["filename"],
-            )
+    return json_list
+
+
+def chunk_model_dictionaries(dataset_model_dictionaries, chunk_size=BULK_CHUNK_SIZE):
+    """Group model dictionaries into chunks for sequence_dataset_add.
+
+    A dataset's dictionaries are never split between chunks, so a
+    dataset with more than chunk_size dictionaries gets a chunk of its
+    own.
 
-            sequence_file_info = tantalus_api.get_or_create(
-                "sequence_file_info",
-                file_resource=file_resource["id"],
-                **sequence_file_info
+    Args:
+        dataset_model_dictionaries: An iterable of lists of model
+            dictionaries, one list per dataset.
+        chunk_size: The most model dictionaries in a chunk.
+
+    Yields:
+        Lists of model dictionaries.
+    """
+    chunk = []
+
+    for model_dictionaries in dataset_model_dictionaries:
+        if chunk and len(chunk) + len(model_dictionaries) > chunk_size:
+            yield chunk
+            chunk = []
+
+        chunk.extend(model_dictionaries)
+
+    if chunk:
+        yield chunk
+
+
+def add_sequence_dataset_models(
+    file_info,
+    storage_name,
+    tag_name,
+    tantalus_api,
+    analysis_id=None,
+    chunk_size=BULK_CHUNK_SIZE,
+):
+    """Create tantalus sequence models for a list of files in bulk.
+
+    The models are posted to the sequence_dataset_add endpoint in
+    chunks of at most chunk_size model dictionaries, rather than being
+    created one request at a time.
+    """
+    dataset_info = group_files_by_dataset(file_info)
+
+    dataset_model_dictionaries = (
+        get_sequence_dataset_model_dictionaries(
+            dataset_name, infos, storage_name, analysis_id
+        )
+        for dataset_name, infos in dataset_info.items()
+    )
+
+    for chunk in chunk_model_dictionaries(dataset_model_dictionaries, chunk_size):
+        tantalus_api.sequence_dataset_add(chunk, tag_name=tag_name)
+
+
+def _create_sequence_dataset(
+    tantalus_api,
+    dataset_name,
+    infos,
+    storage_pk,
+    library_pk,
+    sample_pk,
+    tag_pks,
+    analysis_id,
+    lane_single_flight,
+):
+    """Create the models of one dataset, each after those it refers to.
+
+    Args:
+        tag_pks: A list of the PKs of the tags for the dataset, or None.
+        lane_single_flight: A SingleFlight through which sequencing
+            lanes are created, so that datasets sharing a lane don't
+            race to create it.
+    """
+    # Build up sequence dataset attrs; we'll add to this as we
+    # proceed throughout the function
+    sequence_dataset = dict(
+        name=dataset_name,
+        dataset_type=infos[0]["dataset_type"],
+        sample=sample_pk,
+        library=library_pk,
+        sequence_lanes=[],
+        file_resources=[],
+    )
+
+    # Add in the analysis id if it's provided
+    if analysis_id is not None:
+        sequence_dataset["analysis"] = analysis_id
+
+    # Unique set of lanes keyed by flowcell id, lane number
+    # TODO(mwiens91): What's this for? It's not used anywhere
+    # :thinking:
+    unique_sequence_lanes = {}
+
+    # Add in BAM specific items
+    if infos[0]["dataset_type"] == "BAM":
+        sequence_dataset["aligner"] = infos[0]["aligner_name"]
+        sequence_dataset["reference_genome"] = get_reference_genome(
+            infos[0]["ref_genome"]
+        )
+
+    # Add in the tag if we have one
+    if tag_pks is not None:
+        sequence_dataset["tags"] = tag_pks
+
+    # Check consistency for fields used for dataset
+    check_dataset_file_info(infos)
+
+    for info in infos:
+        for sequence_lane in info["sequence_lanes"]:
+            sequence_lane = dict(sequence_lane)
+            sequence_lane["dna_library"] = library_pk
+            sequence_lane["lane_number"] = str(sequence_lane["lane_number"])
+
+            sequence_lane = lane_single_flight.do(
+                tuple(sorted(sequence_lane.items())),
+                functools.partial(
+                    tantalus_api.get_or_create, "sequencing_lane", **sequence_lane
+                ),
             )
 
-            sequence_dataset["file_resources"].append(file_resource["id"])
+            sequence_dataset["sequence_lanes"].append(sequence_lane["id"])
+
+        sequence_file_info = dict(index_sequence=info["index_sequence"])
+
+        if "read_end" in info:
+            sequence_file_info["read_end"] = info["read_end"]
+
+        file_resource = tantalus_api.get_or_create(
+            "file_resource",
+            size=info["size"],
+            created=info["created"],
+            file_type=info["file_type"],
+            compression=info["compression"],
+            filename=info["filename"],
+        )
+
+        sequence_file_info = tantalus_api.get_or_create(
+            "sequence_file_info",
+            file_resource=file_resource["id"],
+            **sequence_file_info
+        )
+
+        sequence_dataset["file_resources"].append(file_resource["id"])
+
+        file_instance = dict(storage=storage_pk, file_resource=file_resource["id"])
+
+        if "filename_override" in info:
+            file_instance["filename_override"] = info["filename_override"]
+
+        tantalus_api.get_or_create("file_instance", **file_instance)
+
+    tantalus_api.get_or_create("sequence_dataset", **sequence_dataset)
+
+
+def create_sequence_dataset_models(
+    file_info,
+    storage_name,
+    tag_name,
+    tantalus_api,
+    analysis_id=None,
+    bulk=False,
+    num_workers=8,
+):
+    """Create tantalus sequence models for a list of files.
+
+    If bulk is True, the models are created with a few
+    sequence_dataset_add requests instead of one request per model.
+    Otherwise, num_workers datasets are created at a time.
+    """
+    if bulk:
+        return add_sequence_dataset_models(
+            file_info, storage_name, tag_name, tantalus_api, analysis_id=analysis_id
+        )
+
+    # Get storage and tag PKs
+    storage_pk = tantalus_api.get("storage", name=storage_name)["id"]
+
+    if tag_name is not None:
+        tag_pk = tantalus_api.get("sequence_dataset_tag", name=tag_name)["id"]
 
-            file_instance = dict(storage=storage_pk, file_resource=file_resource["id"])
+    # Sort files by dataset
+    dataset_info = group_files_by_dataset(file_info)
+
+    # Look up every library and sample once up front. For DLP, every
+    # cell is its own dataset, but they all share a library.
+    library_pks = get_pks_by_field(
+        tantalus_api,
+        "dna_library",
+        "library_id",
+        (infos[0]["library_id"] for infos in dataset_info.values()),
+    )
+    sample_pks = get_pks_by_field(
+        tantalus_api,
+        "sample",
+        "sample_id",
+        (infos[0]["sample_id"] for infos in dataset_info.values()),
+    )
+
+    # Create datasets concurrently. Lanes are shared between the
+    # datasets of a flowcell, so each lane is created by only one task.
+    lane_single_flight = SingleFlight()
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    try:
+        futures = [
+            executor.submit(
+                _create_sequence_dataset,
+                tantalus_api,
+                dataset_name,
+                infos,
+                storage_pk,
+                library_pks[infos[0]["library_id"]],
+                sample_pks[infos[0]["sample_id"]],
+                [tag_pk] if tag_name is not None else None,
+                analysis_id,
+                lane_single_flight,
+            )
+            for dataset_name, infos in dataset_info.iteritems()
+        ]
 
-            if "filename_override" in info:
-                file_instance["filename_override"] = info["filename_override"]
+        # Raise the first failure once every dataset has been tried
+        for future in futures:
+            future.exception()
 
-            tantalus_api.get_or_create("file_instance", **file_instance)
+        for future in futures:
+            future.result()
+    finally:
+        executor.shutdown()
 
-        tantalus_api.get_or_create("sequence_dataset", **sequence_dataset)
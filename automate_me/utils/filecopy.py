@@ -1,14 +1,29 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+import errno
 import logging
 import os
+import shutil
 from subprocess import Popen, PIPE, STDOUT
 from utils.utils import make_dirs
 
 # Setup logger
 log = logging.getLogger(__name__)
 
+# The most bytes handed to the kernel in a single copy call
+KERNEL_COPY_SIZE = 64 * 1024 * 1024
+
+# The buffer size when copying through userspace
+USERSPACE_COPY_SIZE = 8 * 1024 * 1024
+
+# The most bytes a checksummed copy reads ahead of the data hashed
+CHECKSUM_AHEAD_SIZE = 4 * USERSPACE_COPY_SIZE
+
+# Errors meaning a kernel copy isn't supported between two files, rather
+# than that the copy failed
+_KERNEL_COPY_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSUP)
+
 
 def rsync_file(from_path, to_path):
     make_dirs(os.path.dirname(to_path))
@@ -37,3 +52,161 @@ def rsync_file(from_path, to_path):
 
     if os.path.getsize(to_path) != os.path.getsize(from_path):
         log.error("copy failed for %s to %s", from_path, to_path)
+
+
+def _copy_file_range(from_fd, to_fd, offset, count):
+    return os.copy_file_range(from_fd, to_fd, count, offset, offset)
+
+
+def _sendfile(from_fd, to_fd, offset, count):
+    os.lseek(to_fd, offset, os.SEEK_SET)
+    return os.sendfile(to_fd, from_fd, offset, count)
+
+
+def _kernel_copy(from_fd, to_fd, size, copy_function):
+    offset = 0
+
+    while offset < size:
+        copied = copy_function(
+            from_fd, to_fd, offset, min(KERNEL_COPY_SIZE, size - offset)
+        )
+
+        if not copied:
+            break
+
+        offset += copied
+
+    return offset
+
+
+def copy_file_data(from_file, to_file):
+    """Copy the contents of one open file to another.
+
+    Prefers copies done entirely in the kernel (copy_file_range, then
+    sendfile), which never bring the data into userspace, and falls back
+    to a buffered copy where neither is available or supported between
+    the two files.
+
+    Returns:
+        The name of the method the data was copied with.
+    """
+    size = os.fstat(from_file.fileno()).st_size
+
+    kernel_copy_functions = []
+
+    if hasattr(os, "copy_file_range"):
+        kernel_copy_functions.append(("copy_file_range", _copy_file_range))
+
+    if hasattr(os, "sendfile"):
+        kernel_copy_functions.append(("sendfile", _sendfile))
+
+    for method, copy_function in kernel_copy_functions:
+        try:
+            copied = _kernel_copy(
+                from_file.fileno(), to_file.fileno(), size, copy_function
+            )
+        except OSError as e:
+            if e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                raise
+
+            log.debug("%s not supported, falling back: %s", method, e)
+            continue
+
+        if copied == size:
+            return method
+
+    from_file.seek(0)
+    to_file.seek(0)
+    to_file.truncate()
+    shutil.copyfileobj(from_file, to_file, USERSPACE_COPY_SIZE)
+
+    return "copyfileobj"
+
+
+def copy_file_data_checksummed(from_file, to_file, checksum):
+    """Copy the contents of one open file to another, checksumming them.
+
+    The data is copied through userspace, so that each chunk is handed to
+    the checksum (a StreamingChecksum) as it is copied rather than read
+    again afterwards. If to_file is None, the data is only checksummed.
+    """
+    offset = 0
+
+    for data in iter(lambda: from_file.read(USERSPACE_COPY_SIZE), b""):
+        if to_file is not None:
+            to_file.write(data)
+
+        checksum.update(offset, data)
+        offset += len(data)
+
+        # Don't hold more than a few chunks waiting to be hashed
+        while not checksum.wait_for_offset(offset - CHECKSUM_AHEAD_SIZE):
+            pass
+
+    return "checksummed copy"
+
+
+def copy_file_local(from_path, to_path, hardlink=False, checksum=None):
+    """Copy a file on the same host, as rsync --chmod=F444 --times would.
+
+    The copy is written next to its destination and moved into place
+    once complete. Symlinks are followed.
+
+    Args:
+        from_path: The path of the file to copy.
+        to_path: The path to copy to, which must not exist.
+        hardlink: Whether to hardlink the file instead of copying it
+            when both paths are on the same filesystem. The link shares
+            the source file's permissions, which are made read only.
+        checksum: An optional StreamingChecksum to hand the file's data
+            to as it is copied. Checksummed copies can't be made in the
+            kernel, so they are copied through userspace. A hardlinked
+            file isn't copied, so it is read through the checksum once
+            linked.
+
+    Returns:
+        The name of the method the file was copied with.
+    """
+    from_path = os.path.realpath(from_path)
+    from_stat = os.stat(from_path)
+
+    make_dirs(os.path.dirname(to_path))
+
+    if (
+        hardlink
+        and from_stat.st_dev == os.stat(os.path.dirname(to_path)).st_dev
+    ):
+        try:
+            os.link(from_path, to_path)
+        except OSError as e:
+            # Some filesystems don't support hardlinks
+            if e.errno not in (errno.EPERM, errno.EXDEV, errno.EMLINK):
+                raise
+        else:
+            os.chmod(to_path, 0o444)
+
+            if checksum is not None:
+                with open(to_path, "rb") as linked_file:
+                    copy_file_data_checksummed(linked_file, None, checksum)
+
+            return "hardlink"
+
+    partial_path = to_path + ".part"
+
+    try:
+        with open(from_path, "rb") as from_file:
+            with open(partial_path, "wb") as to_file:
+                if checksum is None:
+                    method = copy_file_data(from_file, to_file)
+                else:
+                    method = copy_file_data_checksummed(from_file, to_file, checksum)
+
+        os.chmod(partial_path, 0o444)
+        os.utime(partial_path, (from_stat.st_atime, from_stat.st_mtime))
+        os.rename(partial_path, to_path)
+    except Exception:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+    return method
@@ -0,0 +1,143 @@
+"""Contains a persistent cache of metadata parsed from BAM headers.
+
+BAM files don't change once they are written, so what an importer
+parses from a header can be reused as long as the file's size and
+modification time (or blob ETag) are the same. Entries live in a SQLite
+database, with a namespace per importer since importers parse headers
+differently.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import json
+import sqlite3
+import threading
+
+
+class BamHeaderCache(object):
+    """A SQLite cache of BAM header metadata for one importer.
+
+    The cache can be sent to worker processes, each of which opens its
+    own connection.
+    """
+
+    def __init__(self, path, namespace):
+        """Open (or create) the cache at a path.
+
+        Args:
+            path: The path of the SQLite database.
+            namespace: The name of the importer whose metadata is cached.
+        """
+        self.path = path
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def __getstate__(self):
+        return dict(path=self.path, namespace=self.namespace)
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["namespace"])
+
+    def _get_connection(self):
+        if self._connection is None:
+            # Worker processes may write at the same time, so wait on
+            # each other's locks for a while
+            self._connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS headers ("
+                "namespace TEXT, storage TEXT, path TEXT, size INTEGER, "
+                "version TEXT, metadata TEXT, "
+                "PRIMARY KEY (namespace, storage, path))"
+            )
+            self._connection.commit()
+
+        return self._connection
+
+    def get(self, storage, path, size, version):
+        """Get the cached metadata for a file, or None.
+
+        Args:
+            storage: The storage directory or blob container of the file.
+            path: The path of the file within the storage.
+            size: The size of the file in bytes.
+            version: The file's modification time or ETag.
+        """
+        with self._lock:
+            row = (
+                self._get_connection()
+                .execute(
+                    "SELECT metadata FROM headers WHERE namespace = ? "
+                    "AND storage = ? AND path = ? AND size = ? AND version = ?",
+                    (self.namespace, storage, path, size, str(version)),
+                )
+                .fetchone()
+            )
+
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def set(self, storage, path, size, version, metadata):
+        """Cache the metadata for a file, replacing any older entry."""
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO headers "
+                "(namespace, storage, path, size, version, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    self.namespace,
+                    storage,
+                    path,
+                    size,
+                    str(version),
+                    json.dumps(metadata),
+                ),
+            )
+            connection.commit()
+
+    def get_or_compute(self, storage, path, size, version, compute):
+        """Get the cached metadata for a file, computing it on a miss.
+
+        Args:
+            compute: A function taking no arguments which returns the
+                metadata for the file, as a JSON serializable value.
+        """
+        metadata = self.get(storage, path, size, version)
+
+        if metadata is None:
+            metadata = compute()
+            self.set(storage, path, size, version, metadata)
+
+        return metadata
+
+
+def get_header_metadata(
+    header_cache, storage, path, size, version, read_header, parse_header
+):
+    """Get a BAM's header metadata, from a cache if there is one.
+
+    Args:
+        header_cache: A BamHeaderCache, or None for no caching.
+        storage: The storage directory or blob container of the BAM.
+        path: The path of the BAM within the storage.
+        size: The size of the BAM in bytes.
+        version: The BAM's modification time or ETag.
+        read_header: A function taking no arguments which reads the
+            header, only called on a cache miss.
+        parse_header: A function taking a header and returning the
+            metadata to cache.
+    """
+
+    def compute():
+        return parse_header(read_header())
+
+    if header_cache is None:
+        return compute()
+
+    return header_cache.get_or_compute(storage, path, size, version, compute)
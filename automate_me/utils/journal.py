@@ -0,0 +1,177 @@
+"""Contains a SQLite journal for resumable file transfers.
+
+The journal records every file in a transfer plan along with the state
+of its transfer, so that an interrupted transfer can pick up where it
+left off without going back to Tantalus for the files it already
+finished.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import json
+import sqlite3
+import threading
+import time
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+# States of transfers which still need to be run
+UNFINISHED_STATES = (PENDING, IN_FLIGHT, FAILED)
+
+
+def _json_default(obj):
+    """Serialize the mapping and list types the API client returns."""
+    if isinstance(obj, Mapping):
+        return dict(obj)
+
+    try:
+        return list(obj)
+    except TypeError:
+        raise TypeError("{!r} is not JSON serializable".format(obj))
+
+
+class JobMismatchError(Exception):
+    """An error for when a journal belongs to a different job."""
+
+    pass
+
+
+class TransferJournal(object):
+    """A journal of the planned transfers for a single job.
+
+    The journal is safe to share between threads.
+    """
+
+    def __init__(self, path):
+        """Open (or create) the journal at a path."""
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS job (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS transfers ("
+                "file_resource_id INTEGER PRIMARY KEY, "
+                "position INTEGER, "
+                "entry TEXT, "
+                "state TEXT, "
+                "bytes INTEGER, "
+                "duration REAL, "
+                "error TEXT, "
+                "updated REAL)"
+            )
+
+    def get_job(self):
+        """Get the job description, or None for a new journal."""
+        with self._lock:
+            rows = self._connection.execute("SELECT key, value FROM job").fetchall()
+
+        if not rows:
+            return None
+
+        return {key: json.loads(value) for key, value in rows}
+
+    def start_job(self, job, plan):
+        """Record a job description and its transfer plan.
+
+        Args:
+            job: A dictionary describing the job, used to make sure a
+                later run is resuming the same job.
+            plan: A list of planned transfers.
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO job (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in job.items()],
+            )
+            self._connection.executemany(
+                "INSERT INTO transfers "
+                "(file_resource_id, position, entry, state, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        entry["file_resource"]["id"],
+                        position,
+                        json.dumps(entry, default=_json_default),
+                        PENDING,
+                        time.time(),
+                    )
+                    for position, entry in enumerate(plan)
+                ],
+            )
+
+    def check_job(self, job):
+        """Make sure the journal belongs to a job.
+
+        Raises:
+            JobMismatchError: The journal was started for a different
+                job.
+        """
+        journal_job = self.get_job()
+
+        if journal_job != json.loads(json.dumps(job)):
+            raise JobMismatchError(
+                "journal {} is for job {}, not {}".format(self.path, journal_job, job)
+            )
+
+    def load_plan(self, states=UNFINISHED_STATES):
+        """Load the planned transfers in some states, in plan order."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT entry FROM transfers WHERE state IN ({}) "
+                "ORDER BY position".format(", ".join("?" * len(states))),
+                tuple(states),
+            ).fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    def _set_state(self, entry, state, **fields):
+        columns = ["state", "updated"] + sorted(fields)
+        values = [state, time.time()] + [fields[key] for key in sorted(fields)]
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE transfers SET {} WHERE file_resource_id = ?".format(
+                    ", ".join("{} = ?".format(column) for column in columns)
+                ),
+                values + [entry["file_resource"]["id"]],
+            )
+
+    def mark_in_flight(self, entry):
+        """Record that a transfer has started."""
+        self._set_state(entry, IN_FLIGHT, error=None)
+
+    def mark_done(self, entry, num_bytes, duration):
+        """Record that a transfer finished and was registered."""
+        self._set_state(entry, DONE, bytes=num_bytes, duration=duration)
+
+    def mark_failed(self, entry, error, duration):
+        """Record that a transfer failed all of its attempts."""
+        self._set_state(entry, FAILED, error=str(error), duration=duration)
+
+    def get_state_counts(self):
+        """Get a dictionary mapping transfer states to counts."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT state, COUNT(*) FROM transfers GROUP BY state"
+            ).fetchall()
+
+        return dict(rows)
+
+    def close(self):
+        """Close the journal's database connection."""
+        with self._lock:
+            self._connection.close()
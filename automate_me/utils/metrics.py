@@ -0,0 +1,203 @@
+"""Contains a collector for machine-readable transfer metrics.
+
+Each finished transfer produces a record with its size, wall time,
+effective throughput, retries and storages, and each run ends with a
+summary record. Records are written as JSON lines.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import collections
+import json
+import logging
+import threading
+import time
+
+
+# Upper bounds in bytes of the file size buckets used in the summary
+SIZE_BUCKETS = (
+    ("<1MB", 1024 ** 2),
+    ("<100MB", 100 * 1024 ** 2),
+    ("<10GB", 10 * 1024 ** 3),
+    (">=10GB", None),
+)
+
+
+def get_size_bucket(num_bytes):
+    """Get the name of the summary size bucket for a file size."""
+    for name, upper_bound in SIZE_BUCKETS:
+        if upper_bound is None or num_bytes < upper_bound:
+            return name
+
+
+def _as_mb_per_s(num_bytes, seconds):
+    if seconds <= 0:
+        return None
+
+    return round(num_bytes / (1024.0 * 1024.0) / seconds, 3)
+
+
+class _Totals(object):
+    def __init__(self):
+        self.files = 0
+        self.failed = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.retries = 0
+
+    def add(self, num_bytes, seconds, retries, succeeded, skipped=False):
+        self.files += 1
+        self.retries += retries
+
+        if skipped:
+            self.skipped += 1
+        elif succeeded:
+            self.bytes += num_bytes
+            self.seconds += seconds
+        else:
+            self.failed += 1
+
+    def as_dict(self):
+        return dict(
+            files=self.files,
+            failed=self.failed,
+            skipped=self.skipped,
+            bytes=self.bytes,
+            transfer_seconds=round(self.seconds, 3),
+            mb_per_s=_as_mb_per_s(self.bytes, self.seconds),
+            retries=self.retries,
+        )
+
+
+class TransferMetrics(object):
+    """Collects transfer records and writes them as JSON lines.
+
+    Safe to share between threads. Without a path, records are only
+    aggregated for the summary.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._file = None if path is None else open(path, "a")
+
+        self._totals = _Totals()
+        self._by_storages = collections.defaultdict(_Totals)
+        self._by_size = collections.defaultdict(_Totals)
+        self._extra = {}
+
+    def _write(self, record):
+        if self._file is not None:
+            self._file.write(json.dumps(record, sort_keys=True) + "\n")
+            self._file.flush()
+
+    def record_transfer(
+        self,
+        filename,
+        num_bytes,
+        seconds,
+        retries,
+        from_storage,
+        to_storage,
+        transfer_type,
+        error=None,
+        skipped=False,
+    ):
+        """Record a finished (or failed) transfer of a single file.
+
+        Args:
+            filename: The filename of the file resource.
+            num_bytes: The size of the file in bytes.
+            seconds: The wall time of the transfer, including retries.
+            retries: The number of retries the transfer needed.
+            from_storage: The name of the source storage.
+            to_storage: The name of the destination storage.
+            transfer_type: The kind of transfer, e.g. "server_to_blob".
+            error: The error the transfer failed with, if it failed.
+            skipped: Whether the file was already at its destination,
+                in which case its bytes don't count as moved.
+        """
+        succeeded = error is None
+        storages = "{} -> {}".format(from_storage, to_storage)
+
+        record = dict(
+            record="transfer",
+            time=time.time(),
+            filename=filename,
+            bytes=num_bytes,
+            seconds=round(seconds, 3),
+            mb_per_s=None if skipped else _as_mb_per_s(num_bytes, seconds),
+            retries=retries,
+            from_storage=from_storage,
+            to_storage=to_storage,
+            transfer_type=transfer_type,
+            succeeded=succeeded,
+            skipped=skipped,
+            error=None if succeeded else str(error),
+        )
+
+        with self._lock:
+            for totals in (
+                self._totals,
+                self._by_storages[storages],
+                self._by_size[get_size_bucket(num_bytes)],
+            ):
+                totals.add(num_bytes, seconds, retries, succeeded, skipped=skipped)
+            self._write(record)
+
+    def get_summary(self):
+        """Get the aggregate metrics for the run so far."""
+        with self._lock:
+            elapsed = time.time() - self._start
+
+            summary = dict(
+                record="summary",
+                time=time.time(),
+                wall_seconds=round(elapsed, 3),
+                wall_mb_per_s=_as_mb_per_s(self._totals.bytes, elapsed),
+                by_storages={
+                    storages: totals.as_dict()
+                    for storages, totals in self._by_storages.items()
+                },
+                by_size={
+                    bucket: totals.as_dict() for bucket, totals in self._by_size.items()
+                },
+            )
+            summary.update(self._totals.as_dict())
+
+        return summary
+
+    def add_extra(self, **extra):
+        """Add fields to the summary record.
+
+        Dictionary fields are merged with any earlier values.
+        """
+        with self._lock:
+            for key, value in extra.items():
+                if isinstance(value, dict) and isinstance(self._extra.get(key), dict):
+                    self._extra[key].update(value)
+                else:
+                    self._extra[key] = value
+
+    def close(self, **extra):
+        """Write and log the run summary, and close the metrics file.
+
+        Any keyword arguments, and fields given to add_extra, are added
+        to the summary record.
+        """
+        self.add_extra(**extra)
+
+        summary = self.get_summary()
+        summary.update(self._extra)
+
+        logging.info("transfer summary: {}".format(json.dumps(summary, sort_keys=True)))
+
+        with self._lock:
+            self._write(summary)
+
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,205 @@
+"""Contains a process-wide progress aggregator for file transfers.
+
+Every transfer reports into one aggregator, which logs a single line
+for the whole run at a fixed interval: files and bytes done out of the
+planned totals, the current rate, and the estimated time remaining.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import collections
+import logging
+import threading
+import time
+from utils.utils import as_gb
+
+
+# The seconds of history the current rate is measured over
+RATE_WINDOW = 60
+
+
+class TransferProgressAggregator(object):
+    """Aggregates the progress of every transfer in the process.
+
+    Transfers are identified by a key (e.g. a file resource ID). Byte
+    level progress is optional: transfers which can't report it count
+    their bytes when they finish.
+    """
+
+    def __init__(self, interval=10):
+        """Set up an aggregator which logs every interval seconds."""
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._renderer = None
+
+        self._files_total = 0
+        self._bytes_total = 0
+        self._files_done = 0
+        self._files_failed = 0
+        self._files_skipped = 0
+        self._bytes_finished = 0
+
+        # Bytes done so far by unfinished transfers, by key
+        self._in_progress = {}
+
+        # (time, bytes done) samples for measuring the current rate
+        self._samples = collections.deque()
+        self._start = time.time()
+
+    def add_planned(self, num_files, num_bytes):
+        """Add planned transfers to the totals."""
+        with self._lock:
+            self._files_total += num_files
+            self._bytes_total += num_bytes
+
+    def get_callback(self, key):
+        """Get an SDK-style progress callback for a transfer.
+
+        Returns:
+            A function taking the bytes done so far and the total bytes.
+        """
+
+        def callback(current, total):
+            with self._lock:
+                self._in_progress[key] = current
+
+        return callback
+
+    def file_done(self, key, num_bytes):
+        """Record a finished transfer of some size."""
+        with self._lock:
+            self._in_progress.pop(key, None)
+            self._files_done += 1
+            self._bytes_finished += num_bytes
+
+    def file_skipped(self, key, num_bytes):
+        """Record a file found already at its destination.
+
+        Its bytes are taken out of the planned total, so that the rate
+        and ETA only count bytes actually moved.
+        """
+        with self._lock:
+            self._in_progress.pop(key, None)
+            self._files_skipped += 1
+            self._bytes_total -= num_bytes
+
+    def file_failed(self, key):
+        """Record a transfer which failed for good."""
+        with self._lock:
+            self._in_progress.pop(key, None)
+            self._files_failed += 1
+
+    def file_retried(self, key):
+        """Forget the progress of a transfer which is starting over."""
+        with self._lock:
+            self._in_progress.pop(key, None)
+
+    def get_snapshot(self):
+        """Get the progress so far.
+
+        Returns:
+            A dictionary containing the files done, failed, skipped and
+            planned ("files_done", "files_failed", "files_skipped",
+            "files_total"), the bytes done
+            and planned ("bytes_done", "bytes_total"), the bytes per
+            second over the last RATE_WINDOW seconds ("rate"), the
+            estimated seconds remaining at that rate ("eta_seconds", None
+            if there is no rate yet), and the seconds since the
+            aggregator was created ("elapsed_seconds").
+        """
+        now = time.time()
+
+        with self._lock:
+            bytes_done = self._bytes_finished + sum(self._in_progress.values())
+
+            self._samples.append((now, bytes_done))
+
+            while len(self._samples) > 2 and self._samples[0][0] < now - RATE_WINDOW:
+                self._samples.popleft()
+
+            first_time, first_bytes = self._samples[0]
+
+            if now > first_time:
+                rate = (bytes_done - first_bytes) / (now - first_time)
+            else:
+                rate = 0.0
+
+            bytes_left = max(self._bytes_total - bytes_done, 0)
+
+            return dict(
+                files_done=self._files_done,
+                files_failed=self._files_failed,
+                files_skipped=self._files_skipped,
+                files_total=self._files_total,
+                bytes_done=bytes_done,
+                bytes_total=self._bytes_total,
+                rate=rate,
+                eta_seconds=int(bytes_left / rate) if rate > 0 else None,
+                elapsed_seconds=int(now - self._start),
+            )
+
+    def log_progress(self):
+        """Log a line of progress."""
+        snapshot = self.get_snapshot()
+
+        if snapshot["eta_seconds"] is None:
+            eta = "unknown"
+        else:
+            eta = "{}s".format(snapshot["eta_seconds"])
+
+        logging.info(
+            "progress: {}/{} files ({} skipped), {}/{} GB, {:.2f} MB/s, ETA {}".format(
+                snapshot["files_done"] + snapshot["files_skipped"],
+                snapshot["files_total"],
+                snapshot["files_skipped"],
+                as_gb(snapshot["bytes_done"]),
+                as_gb(snapshot["bytes_total"]),
+                snapshot["rate"] / (1024.0 * 1024.0),
+                eta,
+            )
+        )
+
+    def _render(self):
+        while not self._stopped.wait(self.interval):
+            self.log_progress()
+
+    def start(self):
+        """Start logging progress every interval."""
+        with self._lock:
+            if self._renderer is None:
+                self._stopped.clear()
+                self._renderer = threading.Thread(target=self._render)
+                self._renderer.daemon = True
+                self._renderer.start()
+
+    def stop(self):
+        """Stop logging progress, logging one final line."""
+        with self._lock:
+            renderer = self._renderer
+            self._renderer = None
+
+        if renderer is not None:
+            self._stopped.set()
+            renderer.join()
+
+        self.log_progress()
+
+
+_progress = TransferProgressAggregator()
+
+
+def get_transfer_progress():
+    """Get the process-wide progress aggregator."""
+    return _progress
+
+
+def reset_transfer_progress(interval=10):
+    """Replace the process-wide progress aggregator with a new one."""
+    global _progress
+
+    _progress = TransferProgressAggregator(interval=interval)
+
+    return _progress
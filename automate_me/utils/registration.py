@@ -0,0 +1,220 @@
+"""Contains a write-behind queue for registering file instances.
+
+Transfers hand their finished files to the queue and move on, and a
+background thread registers the file instances in Tantalus. Every
+registration is written to a local log before it is queued and again
+once it is done, so registrations left over by a crash are replayed
+the next time the log is opened.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+QUEUED = "queued"
+REGISTERED = "registered"
+
+
+class RegistrationError(Exception):
+    """An error for when file instances couldn't be registered."""
+
+    pass
+
+
+class FileInstanceRegistrar(object):
+    """Registers file instances in Tantalus from a background thread.
+
+    Registrations are taken off the queue in batches of up to
+    batch_size. A failed registration is retried, and if it keeps
+    failing it is left in the log to be replayed and reported by close.
+    """
+
+    def __init__(
+        self, tantalus_api, log_path=None, batch_size=100, retries=3, retry_delay=5
+    ):
+        """Start registering, replaying anything left in the log.
+
+        Args:
+            tantalus_api: A TantalusApi instance, which should only be
+                used by the registrar until it is closed.
+            log_path: An optional path to a JSON lines log of
+                registrations. Without one, registrations only live in
+                memory until they are done.
+            batch_size: The most registrations taken off the queue at
+                once.
+            retries: The number of attempts for each registration.
+            retry_delay: The seconds to wait between attempts.
+        """
+        self.tantalus_api = tantalus_api
+        self.log_path = log_path
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._queue = queue.Queue()
+        self._log_lock = threading.Lock()
+        self._failed = []
+        self.num_registered = 0
+
+        unfinished = self._read_log()
+
+        if log_path is None:
+            self._log = None
+        else:
+            self._log = open(log_path, "a")
+
+            # Finish off a line cut short by a crash
+            if os.path.getsize(log_path) > 0:
+                with open(log_path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+
+                    if f.read(1) != b"\n":
+                        self._log.write("\n")
+
+        if unfinished:
+            logging.info(
+                "replaying {} file instance registrations from {}".format(
+                    len(unfinished), log_path
+                )
+            )
+
+        for file_resource_id, storage_id in unfinished:
+            self._queue.put((file_resource_id, storage_id))
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read_log(self):
+        """Get the registrations queued in the log but never done."""
+        if self.log_path is None or not os.path.exists(self.log_path):
+            return []
+
+        unfinished = {}
+
+        with open(self.log_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+
+                key = (record["file_resource"], record["storage"])
+
+                if record["event"] == QUEUED:
+                    unfinished[key] = True
+                else:
+                    unfinished.pop(key, None)
+
+        return list(unfinished)
+
+    def _write_log(self, event, registrations):
+        if self._log is None:
+            return
+
+        with self._log_lock:
+            for file_resource_id, storage_id in registrations:
+                self._log.write(
+                    json.dumps(
+                        dict(
+                            event=event,
+                            file_resource=file_resource_id,
+                            storage=storage_id,
+                            time=time.time(),
+                        )
+                    )
+                    + "\n"
+                )
+
+            self._log.flush()
+            os.fsync(self._log.fileno())
+
+    def register(self, file_resource_id, storage_id):
+        """Queue a file instance to be registered."""
+        self._write_log(QUEUED, [(file_resource_id, storage_id)])
+        self._queue.put((file_resource_id, storage_id))
+
+    def _register(self, file_resource_id, storage_id):
+        for attempt in range(self.retries):
+            try:
+                self.tantalus_api.get_or_create(
+                    "file_instance", file_resource=file_resource_id, storage=storage_id
+                )
+
+                return True
+            except Exception as e:
+                logging.error(
+                    "registering file resource {} on storage {} failed: {}".format(
+                        file_resource_id, storage_id, e
+                    )
+                )
+
+                if attempt < self.retries - 1:
+                    time.sleep(self.retry_delay)
+
+        return False
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # None marks the end of the registrations
+            done = None in batch
+            batch = [registration for registration in batch if registration]
+
+            registered = []
+
+            for file_resource_id, storage_id in batch:
+                if self._register(file_resource_id, storage_id):
+                    registered.append((file_resource_id, storage_id))
+                else:
+                    self._failed.append((file_resource_id, storage_id))
+
+            self._write_log(REGISTERED, registered)
+            self.num_registered += len(registered)
+
+            if registered:
+                logging.info("registered {} file instances".format(len(registered)))
+
+            if done:
+                return
+
+    def close(self):
+        """Wait for every queued registration and close the log.
+
+        Raises:
+            RegistrationError: Some registrations failed every attempt.
+                They are left in the log, if there is one, to be
+                replayed.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+        if self._failed:
+            raise RegistrationError(
+                "failed to register {} file instances, e.g. file resource {} on storage {}".format(
+                    len(self._failed), self._failed[0][0], self._failed[0][1]
+                )
+            )
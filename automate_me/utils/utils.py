@@ -27,6 +27,10 @@ def get_lanes_str(lanes):
     return "{}".format(lanes.hexdigest()[:8])
 
 
+def as_gb(num_bytes):
+    return round(num_bytes / (1024.0 * 1024.0 * 1024.0), 2)
+
+
 def make_dirs(dirname, mode=0o775):
     oldmask = os.umask(0)
     try: